@@ -0,0 +1,275 @@
+"""抽奖机器人离线基准测试。
+
+不连接 Discord 网关，使用本地 Redis (BENCH_REDIS_URL) 或 fakeredis，以及伪造的
+Guild/TextChannel/Message/Reaction 对象，测量:
+  - check_giveaways 单轮耗时 (存储 1k/10k/100k 个抽奖时的空闲轮与到期轮)
+  - process_giveaway_end 在 10k-100k 参与者下的耗时 (实时参与者集合 vs reaction.users() 回填)
+  - 基于归档快照的 reroll 耗时
+  - 出站队列刷新: 一轮到期结算产生的公告合并为几条消息、编辑发出几次
+  - 每个操作的 Redis 往返次数与 Discord REST 调用次数
+
+结果以 JSON 输出，便于与历史结果对比发现性能回退。
+
+用法:
+    pip install -r requirements.txt "fakeredis[lua]"
+    python benchmarks/bench_giveaways.py --output bench_output.json
+    BENCH_REDIS_URL=redis://localhost:6379/15 python benchmarks/bench_giveaways.py --quick
+注意: 使用真实 Redis 时会清空 BENCH_REDIS_URL 指定的数据库。
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+from types import SimpleNamespace
+
+# bot.py 在导入时检查这两个环境变量
+os.environ.setdefault('BOT_TOKEN', 'benchmark')
+os.environ.setdefault('REDIS_URL', os.environ.get('BENCH_REDIS_URL', 'redis://localhost:6379/15'))
+os.environ.setdefault('LOG_LEVEL', 'WARNING') # 逐条结算日志会干扰计时
+os.environ.setdefault('METRICS_PORT', '0')
+os.environ.setdefault('OUTBOX_WINDOW_SECONDS', '3600') # 出站队列由场景显式刷新，避免后台刷新任务混入计时
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nextcord
+import redis.asyncio as redis
+import bot as giveaway_bot
+
+GUILD_ID = 1 << 40
+CHANNEL_ID = 2 << 40
+BOT_USER_ID = 3 << 40
+REQUIRED_ROLE_ID = 4 << 40
+BONUS_ROLE_ID = 5 << 40
+FIRST_MESSAGE_ID = 6 << 40
+FIRST_USER_ID = 7 << 40
+REACTION_PAGE_SIZE = 100 # 与 Discord API 一致
+
+
+# --- 计数器 ---
+class RoundTripCounter:
+    # 统计 Redis 往返: 每条普通命令计 1 次，每次流水线 execute 计 1 次
+    def __init__(self): self.count = 0
+
+    def instrument(self, client):
+        original_execute_command = client.execute_command; original_pipeline = client.pipeline
+        async def execute_command(*args, **kwargs):
+            self.count += 1; return await original_execute_command(*args, **kwargs)
+        def pipeline(*args, **kwargs):
+            pipe = original_pipeline(*args, **kwargs); original_execute = pipe.execute
+            async def execute(*execute_args, **execute_kwargs):
+                self.count += 1; return await original_execute(*execute_args, **execute_kwargs)
+            pipe.execute = execute; return pipe
+        client.execute_command = execute_command; client.pipeline = pipeline
+        return client
+
+class RestCounter:
+    def __init__(self, latency: float): self.latency = latency; self.calls = {}
+
+    async def call(self, route: str):
+        self.calls[route] = self.calls.get(route, 0) + 1
+        if self.latency: await asyncio.sleep(self.latency)
+
+    def reset(self): self.calls = {}
+
+
+# --- 伪造的 Discord 对象 ---
+class FakeRole:
+    def __init__(self, role_id: int, name: str): self.id = role_id; self.name = name; self.mention = f"<@&{role_id}>"
+
+class FakeMember(nextcord.Member):
+    # 继承 nextcord.Member 以通过 isinstance 检查，但不走 Discord 的构造流程
+    def __init__(self, user_id: int, guild, roles: list):
+        self.__dict__.update(_fake_id=user_id, _fake_roles=roles); self.guild = guild
+    id = property(lambda self: self._fake_id)
+    roles = property(lambda self: self._fake_roles)
+    name = property(lambda self: f"user{self._fake_id}")
+    display_name = name
+    mention = property(lambda self: f"<@{self._fake_id}>")
+    bot = False
+
+class FakeGuild:
+    def __init__(self, guild_id: int, members: list, roles: list):
+        self.id = guild_id; self.members = members; self.chunked = True
+        self._members = {m.id: m for m in members}; self._roles = {r.id: r for r in roles}; self._channels = {}
+    def get_member(self, user_id: int): return self._members.get(user_id)
+    def get_role(self, role_id: int): return self._roles.get(role_id)
+    def get_channel(self, channel_id: int): return self._channels.get(channel_id)
+
+class FakeReaction:
+    def __init__(self, rest: RestCounter, users: list):
+        self.emoji = giveaway_bot.GIVEAWAY_EMOJI; self.me = True; self.count = len(users) + 1; self._rest = rest; self._users = users
+    async def users(self):
+        # 与 Discord 一样每页 100 个用户，每页一次 REST 请求
+        for start in range(0, len(self._users), REACTION_PAGE_SIZE):
+            await self._rest.call('reaction_users_page')
+            for user in self._users[start:start + REACTION_PAGE_SIZE]: yield user
+
+class FakeMessage:
+    def __init__(self, message_id: int, channel, rest: RestCounter, reactors: list):
+        self.id = message_id; self.channel = channel; self.guild = channel.guild; self._rest = rest
+        self.reactions = [FakeReaction(rest, reactors)]
+        embed = nextcord.Embed(title="抽奖", description="**奖品:** `benchmark`"); embed.set_footer(text="由 bench 发起 | 状态: RUNNING")
+        self.embeds = [embed]
+    async def edit(self, **kwargs): await self._rest.call('message_edit')
+
+class FakePartialMessage:
+    def __init__(self, rest: RestCounter): self._rest = rest
+    async def edit(self, **kwargs): await self._rest.call('message_edit')
+
+class FakeTextChannel(nextcord.TextChannel):
+    def __init__(self, channel_id: int, guild, rest: RestCounter):
+        self.__dict__.update(_fake_id=channel_id, _rest=rest, _messages={}); self.guild = guild
+    id = property(lambda self: self._fake_id)
+    mention = property(lambda self: f"<#{self._fake_id}>")
+    async def send(self, *args, **kwargs): await self._rest.call('channel_send')
+    async def fetch_message(self, message_id: int):
+        await self._rest.call('fetch_message')
+        if message_id not in self._messages: raise nextcord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Message')
+        return self._messages[message_id]
+    def get_partial_message(self, message_id: int): return FakePartialMessage(self._rest)
+
+class FakeFollowup:
+    async def send(self, *args, **kwargs): pass
+
+class FakeInteraction:
+    def __init__(self, guild): self.guild = guild; self.followup = FakeFollowup(); self.user = SimpleNamespace(id=BOT_USER_ID, display_name="bench")
+
+
+# --- 基准环境 ---
+class Harness:
+    def __init__(self, redis_url: str | None, rest_latency: float):
+        self.redis_url = redis_url; self.round_trips = RoundTripCounter(); self.rest = RestCounter(rest_latency); self.guild = None; self.channel = None
+
+    async def connect(self):
+        if self.redis_url:
+            text_client = redis.from_url(self.redis_url, decode_responses=True); binary_client = redis.from_url(self.redis_url, decode_responses=False); backend = 'redis'
+        else:
+            try: import fakeredis
+            except ImportError: sys.exit("需要 fakeredis (pip install \"fakeredis[lua]\") 或设置 BENCH_REDIS_URL 指向本地 Redis。")
+            server = fakeredis.FakeServer()
+            text_client = fakeredis.FakeAsyncRedis(server=server, decode_responses=True); binary_client = fakeredis.FakeAsyncRedis(server=server, decode_responses=False); backend = 'fakeredis'
+        giveaway_bot.redis_pool = self.round_trips.instrument(text_client); giveaway_bot.redis_binary_pool = self.round_trips.instrument(binary_client)
+        giveaway_bot.bot._connection.user = SimpleNamespace(id=BOT_USER_ID, name="bench")
+        giveaway_bot.bot.get_guild = lambda guild_id: self.guild if self.guild and guild_id == self.guild.id else None
+        giveaway_bot.bot.get_channel = lambda channel_id: self.channel if self.channel and channel_id == self.channel.id else None
+        return backend
+
+    async def reset(self, member_count: int = 0):
+        await giveaway_bot.redis_pool.flushdb()
+        giveaway_bot._schedule_heap.clear(); giveaway_bot._scheduled_end_times.clear(); giveaway_bot._role_member_index.clear(); giveaway_bot._giveaways_in_progress.clear()
+        for task in giveaway_bot._outbox_flush_tasks.values(): task.cancel()
+        giveaway_bot._outbox_flush_tasks.clear(); giveaway_bot._outbox_dirty.clear()
+        roles = [FakeRole(REQUIRED_ROLE_ID, "required"), FakeRole(BONUS_ROLE_ID, "bonus"), FakeRole(GUILD_ID, "@everyone")]
+        # 与 nextcord 一致，每个成员都拥有 @everyone；偶数用户拥有参与条件身份组，每 10 个用户中有 1 个拥有加成身份组
+        members = []; self.guild = FakeGuild(GUILD_ID, members, roles)
+        for i in range(member_count):
+            member_roles = [roles[2]] + ([roles[0]] if i % 2 == 0 else []) + ([roles[1]] if i % 10 == 0 else [])
+            members.append(FakeMember(FIRST_USER_ID + i, self.guild, member_roles))
+        self.guild._members = {m.id: m for m in members}
+        self.channel = FakeTextChannel(CHANNEL_ID, self.guild, self.rest); self.guild._channels[CHANNEL_ID] = self.channel
+        self.rest.reset()
+
+    def giveaway_data(self, message_id: int, end_time: datetime.datetime) -> dict:
+        return {'guild_id': GUILD_ID, 'channel_id': CHANNEL_ID, 'message_id': message_id, 'end_time': end_time, 'winners': 3, 'prize': 'benchmark',
+                'required_role_id': REQUIRED_ROLE_ID, 'required_role_ids': [REQUIRED_ROLE_ID], 'required_role_mode': 'any', 'blacklisted_role_ids': [],
+                'entry_weights': {str(BONUS_ROLE_ID): 3}, 'creator_id': BOT_USER_ID, 'creator_name': 'bench'}
+
+    async def populate(self, count: int, due: int, participants_per_giveaway: int = 20):
+        # 直接用流水线批量写入 (与 save_giveaway_data 相同的键布局)，避免准备阶段本身成为瓶颈
+        now = datetime.datetime.now(datetime.timezone.utc); pipe_batch = 1000
+        for start in range(0, count, pipe_batch):
+            async with giveaway_bot.redis_pool.pipeline(transaction=False) as pipe:
+                for i in range(start, min(start + pipe_batch, count)):
+                    message_id = FIRST_MESSAGE_ID + i; end_time = now - datetime.timedelta(seconds=1) if i < due else now + datetime.timedelta(hours=1 + i % 48)
+                    mapping, _ = giveaway_bot.encode_giveaway_fields(self.giveaway_data(message_id, end_time))
+                    pipe.hset(f"{giveaway_bot.GIVEAWAY_PREFIX}{message_id}", mapping=mapping)
+                    pipe.zadd(giveaway_bot.giveaway_index_key(GUILD_ID), {str(message_id): end_time.timestamp()})
+                    pipe.zadd(f"{giveaway_bot.GUILD_ACTIVE_PREFIX}{GUILD_ID}", {str(message_id): end_time.timestamp()})
+                    if i < due:
+                        reactors = [FIRST_USER_ID + (i + j) % max(len(self.guild.members), 1) for j in range(participants_per_giveaway)] if self.guild.members else []
+                        if reactors: pipe.sadd(f"{giveaway_bot.PARTICIPANTS_PREFIX}{message_id}", *[str(uid) for uid in reactors])
+                        self.channel._messages[message_id] = FakeMessage(message_id, self.channel, self.rest, [])
+                await pipe.execute()
+
+    async def measure(self, coro_factory, repeat: int = 1) -> dict:
+        timings = []; round_trips = []; rest_calls = []
+        for _ in range(repeat):
+            self.rest.reset(); before = self.round_trips.count; started = time.perf_counter()
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull): await coro_factory()
+            timings.append(time.perf_counter() - started); round_trips.append(self.round_trips.count - before); rest_calls.append(dict(self.rest.calls))
+        timings.sort()
+        return {'seconds_min': timings[0], 'seconds_median': timings[len(timings) // 2], 'seconds_max': timings[-1], 'redis_round_trips': round_trips[-1], 'rest_calls': rest_calls[-1], 'repeat': repeat}
+
+
+# --- 场景 ---
+async def bench_tick(harness: Harness, stored: int, due: int) -> dict:
+    await harness.reset(member_count=1000); await harness.populate(stored, due=0)
+    idle = await harness.measure(giveaway_bot.check_giveaways, repeat=5)
+    resync = await harness.measure(lambda: giveaway_bot.resync_schedule(time.time()), repeat=5)
+    await harness.reset(member_count=1000); await harness.populate(stored, due=due)
+    busy = await harness.measure(giveaway_bot.check_giveaways)
+    outbox_flush = await harness.measure(lambda: giveaway_bot.flush_channel_outbox(CHANNEL_ID)) # 所有到期抽奖都在同一频道，公告应合并
+    return {'scenario': 'check_giveaways_tick', 'stored_giveaways': stored, 'due_giveaways': due, 'idle_tick': idle, 'scheduler_resync': resync, 'tick_with_due': busy, 'outbox_flush': outbox_flush}
+
+async def bench_end(harness: Harness, reactors: int) -> dict:
+    await harness.reset(member_count=reactors); message_id = FIRST_MESSAGE_ID
+    giveaway_data = harness.giveaway_data(message_id, datetime.datetime.now(datetime.timezone.utc))
+    message = FakeMessage(message_id, harness.channel, harness.rest, harness.guild.members); harness.channel._messages[message_id] = message
+    async def seed_participants():
+        await giveaway_bot.redis_pool.delete(f"{giveaway_bot.PARTICIPANTS_PREFIX}{message_id}", f"{giveaway_bot.GIVEAWAY_ANNOUNCED_PREFIX}{message_id}")
+        for start in range(0, reactors, 10000): await giveaway_bot.redis_pool.sadd(f"{giveaway_bot.PARTICIPANTS_PREFIX}{message_id}", *[str(m.id) for m in harness.guild.members[start:start + 10000]])
+    await giveaway_bot.save_giveaway_data(message_id, giveaway_data)
+    async def end_with_tracked_set():
+        await giveaway_bot.process_giveaway_end(message, giveaway_data)
+    results = []
+    for _ in range(3):
+        await seed_participants(); results.append(await harness.measure(end_with_tracked_set))
+    tracked = min(results, key=lambda r: r['seconds_min'])
+    reconcile = await harness.measure(lambda: giveaway_bot.reconcile_giveaway_participants(message))
+    participant_ids = {m.id for m in harness.guild.members}
+    async def eligibility_cold_index():
+        giveaway_bot._role_member_index.clear(); giveaway_bot.filter_eligible_participant_ids(harness.guild, participant_ids, giveaway_data)
+    eligibility_cold = await harness.measure(eligibility_cold_index, repeat=3)
+    return {'scenario': 'process_giveaway_end', 'reactors': reactors, 'end_with_tracked_participants': tracked, 'reconcile_from_reactions': reconcile, 'eligibility_with_cold_role_index': eligibility_cold}
+
+async def bench_reroll(harness: Harness, reactors: int) -> dict:
+    await harness.reset(member_count=reactors); message_id = FIRST_MESSAGE_ID
+    giveaway_data = harness.giveaway_data(message_id, datetime.datetime.now(datetime.timezone.utc))
+    await giveaway_bot.archive_giveaway_result(message_id, giveaway_data, {m.id for m in harness.guild.members}, [], draw_seed=0)
+    interaction = FakeInteraction(harness.guild)
+    async def reroll():
+        archive = await giveaway_bot.load_giveaway_archive(message_id); await giveaway_bot.reroll_from_archive(interaction, message_id, archive)
+    return {'scenario': 'giveaway_reroll_from_archive', 'reactors': reactors, 'reroll': await harness.measure(reroll, repeat=3)}
+
+
+def parse_sizes(text: str) -> list[int]:
+    return [int(part) for part in text.split(',') if part.strip()]
+
+async def main():
+    parser = argparse.ArgumentParser(description="抽奖机器人离线基准测试")
+    parser.add_argument('--giveaways', default='1000,10000,100000', help="check_giveaways 场景中存储的抽奖数量 (逗号分隔)")
+    parser.add_argument('--due', type=int, default=50, help="到期轮中同时到期的抽奖数量")
+    parser.add_argument('--reactors', default='10000,50000,100000', help="结算/重抽场景中的参与者数量 (逗号分隔)")
+    parser.add_argument('--rest-latency-ms', type=float, default=0.0, help="模拟每次 Discord REST 调用的延迟")
+    parser.add_argument('--quick', action='store_true', help="使用小规模参数快速运行")
+    parser.add_argument('--output', help="把 JSON 结果写入文件 (默认输出到标准输出)")
+    args = parser.parse_args()
+    if args.quick: args.giveaways, args.reactors, args.due = '1000', '10000', 10
+    harness = Harness(os.environ.get('BENCH_REDIS_URL'), args.rest_latency_ms / 1000)
+    backend = await harness.connect(); results = []
+    for stored in parse_sizes(args.giveaways): results.append(await bench_tick(harness, stored, min(args.due, stored))); print(f"完成: tick {stored}", file=sys.stderr)
+    for reactors in parse_sizes(args.reactors):
+        results.append(await bench_end(harness, reactors)); results.append(await bench_reroll(harness, reactors)); print(f"完成: end/reroll {reactors}", file=sys.stderr)
+    report = {'generated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'python': platform.python_version(), 'nextcord': nextcord.__version__,
+              'redis_backend': backend, 'rest_latency_ms': args.rest_latency_ms, 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    else: print(json.dumps(report, ensure_ascii=False, indent=2))
+    await giveaway_bot.redis_pool.flushdb()
+
+if __name__ == "__main__":
+    asyncio.run(main())
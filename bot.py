@@ -1,41 +1,332 @@
 # --- 导入必要的库 ---
 import nextcord
-from nextcord.ext import commands, tasks
+from nextcord.ext import commands
 import datetime
-import random
+import hashlib
+import math
+import secrets
 import asyncio
+import heapq
+import time
+import collections
+import contextlib
+import functools
+import logging
 import os
+import socket
 import json
+import struct
+import array
+import sys
+import aiohttp
 import redis.asyncio as redis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
 from urllib.parse import urlparse
 
+# --- 日志 ---
+# LOG_FORMAT=json (默认) 时每行输出一个 JSON 对象；通过 extra={'fields': {...}} 附加结构化字段
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {'ts': datetime.datetime.fromtimestamp(record.created, tz=datetime.timezone.utc).isoformat(timespec='milliseconds'), 'level': record.levelname, 'logger': record.name, 'msg': record.getMessage()}
+        payload.update(getattr(record, 'fields', None) or {})
+        if record.exc_info: payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json' else logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+logging.basicConfig(level=LOG_LEVEL, handlers=[_log_handler])
+log = logging.getLogger("giveaway_bot")
+
 # --- 配置 ---
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 REDIS_URL = os.environ.get('REDIS_URL')
-if not BOT_TOKEN: print("错误: 未设置 BOT_TOKEN 环境变量。"); exit()
-if not REDIS_URL: print("错误: 未设置 REDIS_URL 环境变量。请确保已链接 Redis 服务。"); exit()
+if not BOT_TOKEN: log.error("错误: 未设置 BOT_TOKEN 环境变量。"); exit()
+if not REDIS_URL: log.error("错误: 未设置 REDIS_URL 环境变量。请确保已链接 Redis 服务。"); exit()
+REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', '20'))
+REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', '10')) # 连接池耗尽时等待空闲连接的最长时间 (秒)，超时才报错
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', '5'))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('REDIS_CONNECT_TIMEOUT', '5'))
+REDIS_RETRIES = int(os.environ.get('REDIS_RETRIES', '3')) # 连接/超时错误的重试次数 (指数退避)
+REDIS_BACKOFF_BASE = float(os.environ.get('REDIS_BACKOFF_BASE', '0.1'))
+REDIS_BACKOFF_CAP = float(os.environ.get('REDIS_BACKOFF_CAP', '2'))
+PARTICIPANTS_RETENTION_SECONDS = int(os.environ.get('PARTICIPANTS_RETENTION_SECONDS', str(7 * 24 * 3600))) # 为已结束抽奖回填的参与者集合的保留时间
+PARTICIPANTS_SCAN_COUNT = int(os.environ.get('PARTICIPANTS_SCAN_COUNT', '1000')) # 开奖时 SSCAN 每批读取的参与者数量
+ARCHIVE_TTL_SECONDS = int(os.environ.get('ARCHIVE_TTL_SECONDS', str(30 * 24 * 3600))) # 开奖结果快照 (供 reroll 使用) 的保留时间
+SCHEDULER_RESYNC_SECONDS = float(os.environ.get('SCHEDULER_RESYNC_SECONDS', '60')) # 与 Redis 重新同步的间隔 (捕获其他进程创建的抽奖)
+GIVEAWAY_END_CONCURRENCY = int(os.environ.get('GIVEAWAY_END_CONCURRENCY', '8')) # 同时结算的抽奖总数上限
+GUILD_END_CONCURRENCY = int(os.environ.get('GUILD_END_CONCURRENCY', '2')) # 单个服务器同时结算的抽奖上限
+GIVEAWAY_LEASE_SECONDS = int(os.environ.get('GIVEAWAY_LEASE_SECONDS', '120')) # 结算租约时长，进程崩溃后租约到期由其他进程接手
+OUTBOX_WINDOW_SECONDS = float(os.environ.get('OUTBOX_WINDOW_SECONDS', '2')) # 公告/编辑合并窗口，窗口内同一频道的内容合并发送
+OUTBOX_RETRY_SECONDS = float(os.environ.get('OUTBOX_RETRY_SECONDS', '10')) # 发送失败 (限速/网络错误) 后的重试间隔
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '50')) # 单次刷新最多读取的公告条数
+
+# --- 分片 / 多进程配置 ---
+# SHARD_COUNT: 总分片数; WORKER_COUNT/WORKER_INDEX: 进程总数与本进程序号 (未设置时从 Heroku 的 DYNO=worker.N 推断);
+# SHARD_IDS: 显式指定本进程的分片 (如 "0,1" 或 "0-3")，优先于按序号分配。
+def parse_shard_ids(spec: str) -> list[int]:
+    shard_ids = []
+    for part in spec.replace(' ', '').split(','):
+        if not part: continue
+        if '-' in part: start, end = part.split('-', 1); shard_ids.extend(range(int(start), int(end) + 1))
+        else: shard_ids.append(int(part))
+    return sorted(set(shard_ids))
+
+SHARD_COUNT = int(os.environ['SHARD_COUNT']) if os.environ.get('SHARD_COUNT') else None
+WORKER_COUNT = int(os.environ.get('WORKER_COUNT', '1'))
+_dyno = os.environ.get('DYNO', '')
+WORKER_INDEX = int(os.environ.get('WORKER_INDEX') or (int(_dyno.split('.')[-1]) - 1 if _dyno.startswith('worker.') and _dyno.split('.')[-1].isdigit() else 0))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}" # 租约持有者标识
+SHARD_IDS = None
+if os.environ.get('SHARD_IDS'): SHARD_IDS = parse_shard_ids(os.environ['SHARD_IDS'])
+elif WORKER_COUNT > 1:
+    if not SHARD_COUNT: log.error("错误: WORKER_COUNT > 1 时必须设置 SHARD_COUNT 环境变量。"); exit()
+    SHARD_IDS = [shard_id for shard_id in range(SHARD_COUNT) if shard_id % WORKER_COUNT == WORKER_INDEX]
+if SHARD_IDS is not None and not SHARD_COUNT: log.error("错误: 设置 SHARD_IDS 时必须同时设置 SHARD_COUNT。"); exit()
+if SHARD_IDS is not None and not SHARD_IDS: log.error(f"错误: 进程 {WORKER_INDEX} 没有分配到任何分片 (SHARD_COUNT={SHARD_COUNT}, WORKER_COUNT={WORKER_COUNT})。"); exit()
+
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9108')) # 设为 0 关闭 Prometheus 指标端点
+
+# --- 指标 (Prometheus 文本格式) ---
+# 进程内的计数器与直方图，由 /metrics 端点导出；标签以排序后的 (键, 值) 元组存储。
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+_metric_help: dict[str, tuple[str, str]] = {} # 名称 -> (类型, 说明)
+_counters: dict[tuple[str, tuple], float] = collections.defaultdict(float)
+_histograms: dict[tuple[str, tuple], list] = {} # -> [各桶计数, 总和, 次数]
+_histogram_buckets: dict[str, tuple[float, ...]] = {}
+
+def define_metric(name: str, metric_type: str, help_text: str, buckets: tuple[float, ...] = _DEFAULT_BUCKETS):
+    _metric_help[name] = (metric_type, help_text)
+    if metric_type == 'histogram': _histogram_buckets[name] = buckets
+
+def inc_counter(name: str, value: float = 1, **labels):
+    _counters[(name, tuple(sorted(labels.items())))] += value
+
+def observe(name: str, value: float, **labels):
+    key = (name, tuple(sorted(labels.items()))); buckets = _histogram_buckets[name]
+    entry = _histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+    for i, bound in enumerate(buckets):
+        if value <= bound: entry[0][i] += 1
+    entry[1] += value; entry[2] += 1
+
+@contextlib.contextmanager
+def timed(name: str, **labels):
+    started = time.perf_counter()
+    try: yield
+    finally: observe(name, time.perf_counter() - started, **labels)
+
+def timed_redis_op(func):
+    # 记录存储函数的耗时 (标签 op=函数名)
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with timed('giveaway_redis_op_seconds', op=func.__name__): return await func(*args, **kwargs)
+    return wrapper
+
+def instrumented_command(command: str):
+    # 斜杠命令耗时与结果计数；functools.wraps 保留签名，nextcord 仍能解析命令参数
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            outcome = 'ok'
+            try:
+                with timed('giveaway_command_seconds', command=command): return await func(*args, **kwargs)
+            except Exception: outcome = 'error'; raise
+            finally: inc_counter('giveaway_commands_total', command=command, outcome=outcome)
+        return wrapper
+    return decorator
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs: return ''
+    return '{' + ','.join(f'{k}="{_escape_label_value(v)}"' for k, v in pairs) + '}'
+
+def render_metrics() -> str:
+    lines = []
+    for name, (metric_type, help_text) in sorted(_metric_help.items()):
+        lines.append(f"# HELP {name} {help_text}"); lines.append(f"# TYPE {name} {metric_type}")
+        if metric_type == 'counter':
+            for (metric_name, labels), value in sorted(_counters.items()):
+                if metric_name == name: lines.append(f"{name}{_format_labels(labels)} {int(value) if value.is_integer() else repr(value)}") # {:g} 只保留 6 位有效数字
+        else:
+            buckets = _histogram_buckets[name]
+            for (metric_name, labels), (bucket_counts, total, count) in sorted(_histograms.items()):
+                if metric_name != name: continue
+                for bound, bucket_count in zip(buckets, bucket_counts): lines.append(f"{name}_bucket{_format_labels(labels, (('le', f'{bound:g}'),))} {bucket_count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}"); lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request_line = (await asyncio.wait_for(reader.readline(), timeout=5)).decode('latin-1').split()
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''): pass
+        if len(request_line) >= 2 and request_line[0] == 'GET' and request_line[1].split('?')[0] == '/metrics': status = '200 OK'; body = render_metrics().encode()
+        else: status = '404 Not Found'; body = b'not found\n'
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception as e: log.debug(f"处理指标请求时出错: {e}")
+    finally: writer.close()
+
+metrics_server: asyncio.Server | None = None
+async def start_metrics_server():
+    global metrics_server
+    if not METRICS_PORT or metrics_server is not None: return
+    try: metrics_server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT); log.info(f"Prometheus 指标端点: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e: log.error(f"无法启动指标端点 {METRICS_HOST}:{METRICS_PORT}: {e}")
+
+define_metric('giveaway_tick_seconds', 'histogram', "check_giveaways 单轮耗时")
+define_metric('giveaway_ticks_total', 'counter', "check_giveaways 运行次数")
+define_metric('giveaway_due_total', 'counter', "调度器取出的到期抽奖数")
+define_metric('giveaway_scheduler_lag_seconds', 'histogram', "调度器实际唤醒时间与最早期限的差值", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0))
+define_metric('giveaway_end_lateness_seconds', 'histogram', "抽奖实际结算完成时间相对 end_time 的延迟")
+define_metric('giveaway_ended_total', 'counter', "结算结果计数 (outcome)")
+define_metric('giveaway_redis_op_seconds', 'histogram', "存储函数耗时 (op)", buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+define_metric('giveaway_discord_rest_requests_total', 'counter', "Discord REST 请求数 (method, route, status)")
+define_metric('giveaway_discord_rest_seconds', 'histogram', "Discord REST 请求耗时 (method, route)")
+define_metric('giveaway_reaction_fetch_seconds', 'histogram', "reaction.users() 分页回填耗时")
+define_metric('giveaway_reaction_users_fetched_total', 'counter', "通过 reaction.users() 分页获取的用户数")
+define_metric('giveaway_command_seconds', 'histogram', "斜杠命令处理耗时 (command)")
+define_metric('giveaway_commands_total', 'counter', "斜杠命令调用次数 (command, outcome)")
+define_metric('giveaway_outbox_enqueued_total', 'counter', "写入出站队列的公告/编辑数 (kind)")
+define_metric('giveaway_outbox_items_total', 'counter', "出站队列实际处理的公告/编辑数 (kind)，与 enqueued 的差值为被合并的重复编辑")
+define_metric('giveaway_outbox_messages_total', 'counter', "出站队列发出的 Discord 请求数 (kind)")
+define_metric('giveaway_outbox_dropped_total', 'counter', "因不可重试的错误 (非 429/5xx 的 4xx) 被丢弃的公告/编辑数 (kind)")
+define_metric('giveaway_outbox_flush_seconds', 'histogram', "单个频道出站队列刷新耗时")
 
 # --- Bot Intents ---
 intents = nextcord.Intents.default()
 intents.guilds = True
 intents.members = True
 intents.reactions = True
-bot = commands.Bot(intents=intents)
+bot = commands.AutoShardedBot(intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+
+def instrument_discord_http():
+    # 统计所有 Discord REST 请求 (按路由模板，如 /channels/{channel_id}/messages)
+    original_request = bot.http.request
+    @functools.wraps(original_request)
+    async def request(route, *args, **kwargs):
+        labels = {'method': route.method, 'route': route.path}; status = 'ok'
+        try:
+            with timed('giveaway_discord_rest_seconds', **labels): return await original_request(route, *args, **kwargs)
+        except nextcord.HTTPException as e: status = str(e.status); raise
+        except Exception: status = 'error'; raise
+        finally: inc_counter('giveaway_discord_rest_requests_total', status=status, **labels)
+    bot.http.request = request
+
+instrument_discord_http()
+
+def owns_guild(guild_id: int) -> bool:
+    # Discord 分片规则: shard_id = (guild_id >> 22) % shard_count
+    if bot.shard_ids is None or not bot.shard_count: return True
+    return (guild_id >> 22) % bot.shard_count in bot.shard_ids
 
 # --- Redis 连接 ---
 redis_pool = None
+redis_binary_pool = None # 不解码响应，用于读写打包的二进制参与者 ID
 async def setup_redis():
-    global redis_pool
+    global redis_pool, redis_binary_pool
     redis_url_to_use = os.environ.get('REDIS_URL')
-    if not redis_url_to_use: print("错误: 在 setup_redis 中未能获取 REDIS_URL 环境变量！"); await bot.close(); return
+    if not redis_url_to_use: log.error("错误: 在 setup_redis 中未能获取 REDIS_URL 环境变量！"); await bot.close(); return
     try:
-        print(f"正在连接到 Redis: {redis_url_to_use}...")
-        redis_pool = redis.from_url(redis_url_to_use, decode_responses=True)
-        await redis_pool.ping(); print("成功连接到 Redis。")
-    except Exception as e: print(f"致命错误: 无法连接到 Redis: {e}"); await bot.close()
+        log.info(f"正在连接到 Redis: {redis_url_to_use}...")
+        redis_options = dict(max_connections=REDIS_MAX_CONNECTIONS, socket_timeout=REDIS_SOCKET_TIMEOUT, socket_connect_timeout=REDIS_CONNECT_TIMEOUT, health_check_interval=30,
+                             retry=Retry(ExponentialBackoff(cap=REDIS_BACKOFF_CAP, base=REDIS_BACKOFF_BASE), REDIS_RETRIES), retry_on_error=[RedisConnectionError, RedisTimeoutError])
+        # BlockingConnectionPool: 连接数达到上限时排队等待空闲连接，而不是立即抛出 MaxConnectionsError
+        # (普通连接池在重试之前就失败，反应高峰时会静默丢失参与者)
+        redis_pool = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(redis_url_to_use, decode_responses=True, timeout=REDIS_POOL_TIMEOUT, **redis_options))
+        redis_binary_pool = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(redis_url_to_use, decode_responses=False, timeout=REDIS_POOL_TIMEOUT, **redis_options))
+        await redis_pool.ping(); log.info("成功连接到 Redis。")
+    except Exception as e: log.critical(f"致命错误: 无法连接到 Redis: {e}"); await bot.close()
 
 # --- 辅助函数 ---
-GIVEAWAY_PREFIX = "giveaway:"
+GIVEAWAY_PREFIX = "giveaway:" # HASH: 抽奖数据 (end_time 为 epoch 秒)
+GIVEAWAY_INDEX_PREFIX = "giveaways:by_end_time:" # ZSET (每个索引分片): message_id -> end_time 时间戳
+LEGACY_GIVEAWAY_INDEX_KEY = "giveaways:by_end_time" # v2/v3 的全局到期索引，迁移后删除
+INDEX_SHARD_COUNT = SHARD_COUNT or 1 # 未设置 SHARD_COUNT 时只有一个进程，所有抽奖在同一个索引分片
+GIVEAWAY_MIGRATION_KEY = f"giveaways:migrated:v4:{INDEX_SHARD_COUNT}" # v2: 到期索引 + JSON 字符串转 HASH; v3: 服务器索引; v4: 按分片的到期索引 (分片数变化时重建)
+GUILD_ACTIVE_PREFIX = "giveaways:guild_active:" # ZSET (每服务器): message_id -> end_time 时间戳
+GUILD_ENDED_PREFIX = "giveaways:guild_ended:" # ZSET (每服务器): message_id -> 结束时间戳，只保留最近 GUILD_ENDED_HISTORY 个
+GUILD_ENDED_HISTORY = 200
+LIST_PAGE_SIZE = 10
+
+def giveaway_index_key(guild_id: int | str | None) -> str:
+    # 与 Discord 分片规则一致 (guild_id >> 22) % shard_count，每个进程只读取自己分片的到期索引
+    return f"{GIVEAWAY_INDEX_PREFIX}{(int(guild_id) >> 22) % INDEX_SHARD_COUNT if guild_id else 0}"
+
+def owned_giveaway_index_keys() -> list[str]:
+    return [f"{GIVEAWAY_INDEX_PREFIX}{shard_id}" for shard_id in (SHARD_IDS if SHARD_IDS is not None else range(INDEX_SHARD_COUNT))]
+_GIVEAWAY_INT_FIELDS = {'guild_id', 'channel_id', 'message_id', 'winners', 'required_role_id', 'creator_id'}
+_GIVEAWAY_JSON_FIELDS = {'required_role_ids', 'blacklisted_role_ids', 'entry_weights'}
+PARTICIPANTS_PREFIX = "giveaway_participants:" # SET: 参与者用户 ID (由原始反应事件实时维护)
+ARCHIVE_PREFIX = "giveaway_archive:" # HASH: 开奖结果快照，pool 为打包的 uint64 合格参与者 ID
+ARCHIVE_WINNERS_PREFIX = "giveaway_archive_winners:" # STRING: 打包的 uint64 历史获奖者 ID (APPEND 追加)
+ARCHIVE_SEEDS_PREFIX = "giveaway_archive_seeds:" # STRING: 打包的 uint64 各次重抽的抽奖种子 (APPEND 追加)，首次开奖的种子在归档 HASH 的 draw_seed 中
+GIVEAWAY_LEASE_PREFIX = "giveaway_lease:" # STRING: 正在结算该抽奖的进程 (SET NX EX)
+GIVEAWAY_ANNOUNCED_PREFIX = "giveaway_announced:" # STRING: 已发送获奖公告的标记，防止重复公告
+GIVEAWAY_ANNOUNCED_TTL_SECONDS = 7 * 24 * 3600
+OUTBOX_CHANNELS_KEY = "giveaway_outbox:channels" # SET: 有待发送公告/编辑的频道 ID
+OUTBOX_ANNOUNCE_PREFIX = "giveaway_outbox:announce:" # LIST (每频道): 待合并发送的公告文本
+OUTBOX_EDITS_PREFIX = "giveaway_outbox:edits:" # HASH (每频道): message_id -> 最新的 Embed 状态 (JSON)，重复编辑直接覆盖
+GIVEAWAY_EMOJI = "🎉"
+_RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+# 仅当抽奖仍在进行时才修改参与者集合，这样抽奖结束后的参与者池保持不变
+_PARTICIPANT_UPDATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    if ARGV[1] == 'add' then return redis.call('SADD', KEYS[2], ARGV[2]) end
+    return redis.call('SREM', KEYS[2], ARGV[2])
+end
+return 0
+"""
+# 仅当抽奖记录仍存在时才更新字段与索引: 与结算竞争时不会重新创建一个只有部分字段的记录。
+# ARGV: message_id, 新 end_time (不修改时为空), 写入字段数, 服务器索引前缀, 字段/值..., 要删除的字段...
+_UPDATE_FIELDS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+local set_count = tonumber(ARGV[3])
+for i = 5, 4 + set_count * 2, 2 do redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1]) end
+for i = 5 + set_count * 2, #ARGV do redis.call('HDEL', KEYS[1], ARGV[i]) end
+if ARGV[2] ~= '' then
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+    local guild_id = redis.call('HGET', KEYS[1], 'guild_id')
+    if guild_id then redis.call('ZADD', ARGV[4] .. guild_id, ARGV[2], ARGV[1]) end
+end
+return 1
+"""
+# 先清理到期索引条目；仅当抽奖记录仍存在时才删除，并把它从服务器进行中索引移入服务器"最近结束"索引；返回 1 表示已删除。
+# KEYS: 抽奖记录, 参与者集合, 到期索引分片; ARGV: message_id, 结束时间戳, 进行中索引前缀, 最近结束索引前缀, 保留条数
+_DELETE_GIVEAWAY_SCRIPT = """
+redis.call('ZREM', KEYS[3], ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+local guild_id = false
+if redis.call('TYPE', KEYS[1]).ok == 'hash' then guild_id = redis.call('HGET', KEYS[1], 'guild_id') end
+redis.call('DEL', KEYS[1], KEYS[2])
+if guild_id then
+    redis.call('ZREM', ARGV[3] .. guild_id, ARGV[1])
+    redis.call('ZADD', ARGV[4] .. guild_id, ARGV[2], ARGV[1])
+    redis.call('ZREMRANGEBYRANK', ARGV[4] .. guild_id, 0, -tonumber(ARGV[5]) - 1)
+end
+return 1
+"""
+# 编辑发送成功后，仅当队列中仍是刚发送的版本时才删除 (期间写入的更新状态保留到下次刷新)
+_OUTBOX_ACK_EDIT_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then return redis.call('HDEL', KEYS[1], ARGV[1]) end
+return 0
+"""
+# 频道队列清空后才从待处理集合中移除，返回 1 表示已清空
+_OUTBOX_CLEANUP_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) == 0 and redis.call('HLEN', KEYS[2]) == 0 then redis.call('SREM', KEYS[3], ARGV[1]); return 1 end
+return 0
+"""
 
 def parse_duration(duration_str: str) -> datetime.timedelta | None:
     duration_str = duration_str.lower().strip(); value_str = ""; unit = ""
@@ -52,44 +343,371 @@ def parse_duration(duration_str: str) -> datetime.timedelta | None:
         else: return None
     except ValueError: return None
 
+def encode_giveaway_fields(data: dict) -> tuple[dict[str, str], list[str]]:
+    # 返回 (要写入的字段, 值为 None 需删除的字段)
+    mapping = {}; removed = []
+    for field, value in data.items():
+        if value is None: removed.append(field)
+        elif field == 'end_time' and isinstance(value, datetime.datetime): mapping[field] = str(int((value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)).timestamp()))
+        elif field in _GIVEAWAY_JSON_FIELDS: mapping[field] = json.dumps(value)
+        else: mapping[field] = str(value)
+    return mapping, removed
+
+def decode_giveaway_fields(message_id: int, raw: dict[str, str]) -> dict:
+    data = {}
+    for field, value in raw.items():
+        try:
+            if field == 'end_time': data[field] = datetime.datetime.fromtimestamp(int(value), tz=datetime.timezone.utc)
+            elif field in _GIVEAWAY_INT_FIELDS: data[field] = int(value)
+            elif field in _GIVEAWAY_JSON_FIELDS: data[field] = json.loads(value)
+            else: data[field] = value
+        except (ValueError, json.JSONDecodeError): log.warning(f"警告: 抽奖 {message_id} 的字段 {field} 格式无效: {value!r}"); data[field] = value
+    for field in _GIVEAWAY_INT_FIELDS | {'end_time'}: data.setdefault(field, None)
+    return data
+
+def decode_legacy_giveaway(message_id: int, data_str: str) -> dict | None:
+    # 旧格式: 整个抽奖为一个 JSON 字符串，end_time 为 ISO 字符串
+    try: data = json.loads(data_str)
+    except json.JSONDecodeError: log.error(f"从 Redis 解码抽奖 {message_id} 的 JSON 时出错。"); return None
+    if isinstance(data.get('end_time'), str):
+        try: data['end_time'] = datetime.datetime.fromisoformat(data['end_time'])
+        except ValueError: log.warning(f"警告: 抽奖 {message_id} 的 end_time 格式无效 (非 ISO string?)。")
+    return data
+
+@timed_redis_op
 async def save_giveaway_data(message_id: int, data: dict):
     if not redis_pool: return
     try:
         key = f"{GIVEAWAY_PREFIX}{message_id}"
-        data_to_save = data.copy()
-        if isinstance(data_to_save.get('end_time'), datetime.datetime):
-            if data_to_save['end_time'].tzinfo is None:
-                 data_to_save['end_time'] = data_to_save['end_time'].replace(tzinfo=datetime.timezone.utc)
-            data_to_save['end_time'] = data_to_save['end_time'].isoformat()
-        await redis_pool.set(key, json.dumps(data_to_save))
-    except TypeError as e: print(f"保存抽奖数据 {message_id} 到 Redis 时出错 (序列化失败): {e}")
-    except Exception as e: print(f"保存抽奖数据 {message_id} 到 Redis 时发生其他错误: {e}")
+        mapping, _ = encode_giveaway_fields(data); end_score = float(mapping['end_time']) if 'end_time' in mapping else None
+        async with redis_pool.pipeline(transaction=True) as pipe:
+            pipe.delete(key); pipe.hset(key, mapping=mapping)
+            if end_score is not None: pipe.zadd(giveaway_index_key(data.get('guild_id')), {str(message_id): end_score})
+            else: pipe.zrem(giveaway_index_key(data.get('guild_id')), str(message_id))
+            if data.get('guild_id'): pipe.zadd(f"{GUILD_ACTIVE_PREFIX}{data['guild_id']}", {str(message_id): end_score or 0})
+            await pipe.execute()
+        if end_score is not None: schedule_giveaway(message_id, end_score)
+        else: unschedule_giveaway(message_id)
+    except (TypeError, ValueError) as e: log.error(f"保存抽奖数据 {message_id} 到 Redis 时出错 (序列化失败): {e}")
+    except Exception as e: log.error(f"保存抽奖数据 {message_id} 到 Redis 时发生其他错误: {e}")
+
+@timed_redis_op
+async def update_many_giveaway_fields(updates: dict[int, dict]) -> list[int]:
+    # 批量字段级更新 (message_id -> 字段)，不重写整条记录；值为 None 的字段会被删除。
+    # 修改 end_time 时同步更新到期索引、服务器索引与本地调度堆。已结束 (记录不存在) 的抽奖被跳过，返回实际更新的 ID
+    if not redis_pool or not updates: return []
+    try:
+        encoded = {message_id: encode_giveaway_fields(fields) for message_id, fields in updates.items() if fields}
+        rescheduled = [message_id for message_id, (mapping, _) in encoded.items() if 'end_time' in mapping]; guild_ids = {}
+        if rescheduled: # 到期索引按分片存放，需先知道服务器 ID (记录在此期间被删除时脚本会跳过)
+            async with redis_pool.pipeline(transaction=False) as pipe:
+                for message_id in rescheduled: pipe.hget(f"{GIVEAWAY_PREFIX}{message_id}", 'guild_id')
+                guild_ids = dict(zip(rescheduled, await pipe.execute()))
+        async with redis_pool.pipeline(transaction=False) as pipe:
+            for message_id, (mapping, removed) in encoded.items():
+                pipe.eval(_UPDATE_FIELDS_SCRIPT, 2, f"{GIVEAWAY_PREFIX}{message_id}", giveaway_index_key(updates[message_id].get('guild_id') or guild_ids.get(message_id)), str(message_id), mapping.get('end_time', ''), len(mapping), GUILD_ACTIVE_PREFIX, *[part for item in mapping.items() for part in item], *removed)
+            replies = await pipe.execute()
+        updated = [message_id for message_id, reply in zip(encoded, replies) if reply]
+        for message_id in updated:
+            if 'end_time' in encoded[message_id][0]: schedule_giveaway(message_id, float(encoded[message_id][0]['end_time']))
+        return updated
+    except Exception as e: log.error(f"批量更新抽奖 {list(updates)} 字段时出错: {e}"); return []
 
+async def update_giveaway_fields(message_id: int, **fields) -> bool:
+    # 字段级更新，不重写整条记录；值为 None 的字段会被删除
+    return bool(await update_many_giveaway_fields({message_id: fields}))
+
+@timed_redis_op
+async def load_many(message_ids: list[int]) -> dict[int, dict]:
+    # 一次流水线往返读取多个抽奖；旧的 JSON 字符串记录会被读取并就地转换为 HASH
+    if not redis_pool or not message_ids: return {}
+    results = {}; legacy_ids = []
+    try:
+        async with redis_pool.pipeline(transaction=False) as pipe:
+            for message_id in message_ids: pipe.hgetall(f"{GIVEAWAY_PREFIX}{message_id}")
+            replies = await pipe.execute(raise_on_error=False)
+        for message_id, reply in zip(message_ids, replies):
+            if isinstance(reply, Exception):
+                if 'WRONGTYPE' in str(reply): legacy_ids.append(message_id)
+                else: log.error(f"从 Redis 加载抽奖数据 {message_id} 时出错: {reply}")
+            elif reply: results[message_id] = decode_giveaway_fields(message_id, reply)
+        if legacy_ids:
+            for message_id, data_str in zip(legacy_ids, await redis_pool.mget([f"{GIVEAWAY_PREFIX}{message_id}" for message_id in legacy_ids])):
+                if data_str and (data := decode_legacy_giveaway(message_id, data_str)): results[message_id] = data; await save_giveaway_data(message_id, data)
+    except Exception as e: log.error(f"从 Redis 批量加载抽奖数据时出错: {e}")
+    return results
 
 async def load_giveaway_data(message_id: int) -> dict | None:
-    if not redis_pool: return None
+    return (await load_many([message_id])).get(message_id)
+
+@timed_redis_op
+async def delete_many(message_ids: list[int], guild_ids: dict[int, int] | None = None) -> list[int]:
+    # 删除进行中的记录，并把它们移入所属服务器的"最近结束"索引 (参与者池已归档到快照中)；返回实际删除的 ID。
+    # 到期索引按分片存放，需要服务器 ID: 调用方已知时传入 guild_ids 省去一次读取往返
+    if not redis_pool or not message_ids: return []
     try:
-        key = f"{GIVEAWAY_PREFIX}{message_id}"
-        data_str = await redis_pool.get(key)
-        if data_str:
-            data = json.loads(data_str)
-            if isinstance(data.get('end_time'), str):
-                try: data['end_time'] = datetime.datetime.fromisoformat(data['end_time'])
-                except ValueError: print(f"警告: 抽奖 {message_id} 的 end_time 格式无效 (非 ISO string?)。")
-            return data
-        return None
-    except json.JSONDecodeError: print(f"从 Redis 解码抽奖 {message_id} 的 JSON 时出错。"); return None
-    except Exception as e: print(f"从 Redis 加载抽奖数据 {message_id} 时出错: {e}"); return None
-
-async def delete_giveaway_data(message_id: int):
-     if not redis_pool: return
-     try: key = f"{GIVEAWAY_PREFIX}{message_id}"; await redis_pool.delete(key)
-     except Exception as e: print(f"从 Redis 删除抽奖数据 {message_id} 时出错: {e}")
+        if guild_ids is None:
+            async with redis_pool.pipeline(transaction=False) as pipe:
+                for message_id in message_ids: pipe.hget(f"{GIVEAWAY_PREFIX}{message_id}", 'guild_id')
+                replies = await pipe.execute(raise_on_error=False)
+            guild_ids = {message_id: int(reply) for message_id, reply in zip(message_ids, replies) if isinstance(reply, str) and reply.isdigit()}
+        ended_at = str(time.time())
+        async with redis_pool.pipeline(transaction=False) as pipe:
+            for message_id in message_ids:
+                pipe.eval(_DELETE_GIVEAWAY_SCRIPT, 3, f"{GIVEAWAY_PREFIX}{message_id}", f"{PARTICIPANTS_PREFIX}{message_id}", giveaway_index_key(guild_ids.get(message_id)),
+                          str(message_id), ended_at, GUILD_ACTIVE_PREFIX, GUILD_ENDED_PREFIX, GUILD_ENDED_HISTORY)
+            replies = await pipe.execute()
+        if unknown_guild := [str(message_id) for message_id in message_ids if message_id not in guild_ids]: # 服务器未知时从所有索引分片中移除
+            async with redis_pool.pipeline(transaction=False) as pipe:
+                for shard_id in range(INDEX_SHARD_COUNT): pipe.zrem(f"{GIVEAWAY_INDEX_PREFIX}{shard_id}", *unknown_guild)
+                await pipe.execute()
+        for message_id in message_ids: unschedule_giveaway(message_id)
+        return [message_id for message_id, deleted in zip(message_ids, replies) if deleted]
+    except Exception as e: log.error(f"从 Redis 批量删除抽奖数据 {message_ids} 时出错: {e}"); return []
+
+async def delete_giveaway_data(message_id: int) -> bool:
+    return bool(await delete_many([message_id]))
+
+async def end_many_now(message_ids: list[int]) -> list[int]:
+    # 批量提前结束: 把 end_time 改为现在，由调度器按并发限制统一结算；返回仍在进行并已提前的抽奖
+    now = datetime.datetime.fromtimestamp(int(time.time()), tz=datetime.timezone.utc)
+    return await update_many_giveaway_fields({message_id: {'end_time': now} for message_id in message_ids})
+
+async def get_guild_giveaway_page(guild_id: int, status: str, page: int) -> tuple[list[tuple[int, float]], int]:
+    # 只读取该服务器索引中的一页: 返回 ([(message_id, 时间戳)], 总数)
+    if not redis_pool: return [], 0
+    key = f"{GUILD_ACTIVE_PREFIX}{guild_id}" if status == 'active' else f"{GUILD_ENDED_PREFIX}{guild_id}"; start = (page - 1) * LIST_PAGE_SIZE
+    try:
+        async with redis_pool.pipeline(transaction=False) as pipe:
+            pipe.zcard(key)
+            if status == 'active': pipe.zrange(key, start, start + LIST_PAGE_SIZE - 1, withscores=True) # 最早结束的在前
+            else: pipe.zrevrange(key, start, start + LIST_PAGE_SIZE - 1, withscores=True) # 最近结束的在前
+            total, entries = await pipe.execute()
+        return [(int(m), float(score)) for m, score in entries], total
+    except Exception as e: log.error(f"从 Redis 读取服务器 {guild_id} 抽奖列表时出错: {e}"); return [], 0
+
+async def get_guild_active_giveaway_ids(guild_id: int, message_ids: list[int] | None = None) -> list[int]:
+    # message_ids 为 None 时返回该服务器全部进行中的抽奖，否则返回其中属于该服务器且仍在进行的部分
+    if not redis_pool: return []
+    key = f"{GUILD_ACTIVE_PREFIX}{guild_id}"
+    try:
+        if message_ids is None: return [int(m) for m in await redis_pool.zrange(key, 0, -1)]
+        async with redis_pool.pipeline(transaction=False) as pipe:
+            for message_id in message_ids: pipe.zscore(key, str(message_id))
+            scores = await pipe.execute()
+        return [message_id for message_id, score in zip(message_ids, scores) if score is not None]
+    except Exception as e: log.error(f"从 Redis 读取服务器 {guild_id} 抽奖索引时出错: {e}"); return []
+
+async def _read_owned_index(min_score: float | str, max_score: float | str) -> list[tuple[int, float]]:
+    # 一次流水线读取本进程负责的所有分片索引，按 end_time 合并
+    async with redis_pool.pipeline(transaction=False) as pipe:
+        for index_key in owned_giveaway_index_keys(): pipe.zrangebyscore(index_key, min_score, max_score, withscores=True)
+        replies = await pipe.execute()
+    return sorted(((int(m), float(score)) for entries in replies for m, score in entries), key=lambda entry: entry[1])
 
 async def get_all_giveaway_ids() -> list[int]:
      if not redis_pool: return []
-     try: keys = await redis_pool.keys(f"{GIVEAWAY_PREFIX}*"); return [int(k.split(':')[-1]) for k in keys]
-     except Exception as e: print(f"从 Redis 获取抽奖键时出错: {e}"); return []
+     try: return [message_id for message_id, _ in await _read_owned_index('-inf', '+inf')]
+     except Exception as e: log.error(f"从 Redis 获取抽奖索引时出错: {e}"); return []
+
+async def get_due_giveaway_ids(now: datetime.datetime) -> list[int]:
+     # 只取出本进程分片中 end_time <= now 的抽奖 (每个分片一次 ZRANGEBYSCORE)，无需扫描整个键空间
+     if not redis_pool: return []
+     try: return [message_id for message_id, _ in await _read_owned_index('-inf', now.timestamp())]
+     except Exception as e: log.error(f"从 Redis 获取到期抽奖时出错: {e}"); return []
+
+async def get_giveaway_ids_due_before(timestamp: float) -> list[tuple[int, float]]:
+     if not redis_pool: return []
+     try: return await _read_owned_index('-inf', timestamp)
+     except Exception as e: log.error(f"从 Redis 获取即将到期的抽奖时出错: {e}"); return []
+
+async def migrate_giveaway_index():
+    # 一次性迁移: 用 SCAN (非阻塞) 遍历 giveaway:* 键，旧 JSON 记录转换为 HASH，并建立按分片的到期索引。
+    # 分片数变化时迁移键随之变化: 先删除旧的全局索引与所有分片索引，再按新的分片数重建
+    if not redis_pool: return
+    try:
+        if await redis_pool.get(GIVEAWAY_MIGRATION_KEY): return
+        log.info(f"正在迁移现有抽奖数据并建立到期索引 ({INDEX_SHARD_COUNT} 个分片)..."); indexed = 0; batch = []
+        await redis_pool.delete(LEGACY_GIVEAWAY_INDEX_KEY)
+        async for key in redis_pool.scan_iter(match=f"{GIVEAWAY_INDEX_PREFIX}*", count=500): await redis_pool.delete(key)
+        async def index_batch(message_ids: list[int]) -> int:
+            giveaways = {message_id: data for message_id, data in (await load_many(message_ids)).items() if isinstance(data.get('end_time'), datetime.datetime)}
+            if not giveaways: return 0
+            async with redis_pool.pipeline(transaction=False) as pipe:
+                for message_id, data in giveaways.items():
+                    pipe.zadd(giveaway_index_key(data.get('guild_id')), {str(message_id): data['end_time'].timestamp()})
+                    if data.get('guild_id'): pipe.zadd(f"{GUILD_ACTIVE_PREFIX}{data['guild_id']}", {str(message_id): data['end_time'].timestamp()})
+                await pipe.execute()
+            return len(giveaways)
+        async for key in redis_pool.scan_iter(match=f"{GIVEAWAY_PREFIX}*", count=500):
+            try: batch.append(int(key.split(':')[-1]))
+            except ValueError: continue
+            if len(batch) >= 500: indexed += await index_batch(batch); batch = []
+        if batch: indexed += await index_batch(batch)
+        await redis_pool.set(GIVEAWAY_MIGRATION_KEY, "1"); log.info(f"抽奖数据迁移完成，共索引 {indexed} 个抽奖。")
+    except Exception as e: log.error(f"迁移抽奖数据时出错: {e}")
+
+async def update_giveaway_participant(message_id: int, user_id: int, action: str):
+    if not redis_pool: return
+    try: await redis_pool.eval(_PARTICIPANT_UPDATE_SCRIPT, 2, f"{GIVEAWAY_PREFIX}{message_id}", f"{PARTICIPANTS_PREFIX}{message_id}", action, str(user_id))
+    except Exception as e: log.error(f"更新抽奖 {message_id} 参与者 {user_id} 时出错: {e}")
+
+async def load_giveaway_participant_ids(message_id: int) -> set[int]:
+    if not redis_pool: return set()
+    try: return {int(uid) for uid in await redis_pool.smembers(f"{PARTICIPANTS_PREFIX}{message_id}")}
+    except Exception as e: log.error(f"从 Redis 加载抽奖 {message_id} 参与者时出错: {e}"); return set()
+
+async def reconcile_giveaway_participants(message: nextcord.Message) -> set[int]:
+    # 通过 reaction.users() 分页回填参与者集合 (用于停机期间错过的反应事件或旧抽奖)。
+    # 分页可能持续数分钟，期间实时反应事件仍在修改集合，因此只做合并: SADD 分页结果，
+    # 只 SREM 分页开始前已在集合中、且分页未见到的用户 (确认已取消反应)。
+    reaction = nextcord.utils.get(message.reactions, emoji=GIVEAWAY_EMOJI)
+    if not reaction: return set()
+    key = f"{PARTICIPANTS_PREFIX}{message.id}"; known_ids = await load_giveaway_participant_ids(message.id)
+    with timed('giveaway_reaction_fetch_seconds'): participant_ids = {m.id async for m in reaction.users() if isinstance(m, nextcord.Member) and m.id != bot.user.id}
+    inc_counter('giveaway_reaction_users_fetched_total', len(participant_ids))
+    if not redis_pool: return participant_ids
+    try:
+        is_active = await redis_pool.exists(f"{GIVEAWAY_PREFIX}{message.id}"); absent_ids = known_ids - participant_ids
+        async with redis_pool.pipeline(transaction=True) as pipe:
+            if participant_ids: pipe.sadd(key, *[str(uid) for uid in participant_ids])
+            if absent_ids: pipe.srem(key, *[str(uid) for uid in absent_ids])
+            if not is_active: pipe.expire(key, PARTICIPANTS_RETENTION_SECONDS)
+            await pipe.execute()
+    except Exception as e: log.error(f"回填抽奖 {message.id} 参与者到 Redis 时出错: {e}")
+    return participant_ids
+
+async def get_giveaway_participant_ids(message: nextcord.Message) -> set[int]:
+    participant_ids = await load_giveaway_participant_ids(message.id)
+    if participant_ids: return participant_ids
+    reaction = nextcord.utils.get(message.reactions, emoji=GIVEAWAY_EMOJI)
+    if reaction and reaction.count > (1 if reaction.me else 0): log.info(f"抽奖 {message.id} 无参与者记录，从反应回填..."); return await reconcile_giveaway_participants(message)
+    return set()
+
+async def scan_eligible_participant_ids(message: nextcord.Message, giveaway_data: dict) -> array.array:
+    # 开奖用: SSCAN 分批读取参与者集合，逐个 ID 对照身份组索引判断资格，合格 ID 直接写入 8 字节/ID 的紧凑数组 (即归档池)，
+    # 不在内存中构建完整的参与者集合。SSCAN 在集合 rehash 期间可能重复返回同一 ID，抽样时会跳过重复；集合为空时回退到从反应回填
+    is_eligible = make_eligibility_fn(message.guild, giveaway_data); eligible_ids = array.array('Q'); scanned = 0
+    if redis_pool:
+        async for raw_id in redis_pool.sscan_iter(f"{PARTICIPANTS_PREFIX}{message.id}", count=PARTICIPANTS_SCAN_COUNT):
+            scanned += 1; user_id = int(raw_id)
+            if is_eligible(user_id): eligible_ids.append(user_id)
+    if not scanned: eligible_ids.extend(user_id for user_id in await get_giveaway_participant_ids(message) if is_eligible(user_id))
+    return eligible_ids
+
+async def reconcile_active_giveaways():
+    # 启动/重连后对所有进行中的抽奖做一次对账
+    giveaway_ids = await get_all_giveaway_ids(); reconciled = 0; giveaways = await load_many(giveaway_ids)
+    for message_id in giveaway_ids:
+        giveaway_data = giveaways.get(message_id)
+        if not giveaway_data or not giveaway_data.get('guild_id') or not owns_guild(giveaway_data['guild_id']): continue
+        guild = bot.get_guild(giveaway_data['guild_id']); channel = guild.get_channel(giveaway_data['channel_id']) if guild else None
+        if not isinstance(channel, nextcord.TextChannel): continue
+        try:
+            message = await channel.fetch_message(message_id); reaction = nextcord.utils.get(message.reactions, emoji=GIVEAWAY_EMOJI)
+            if not reaction: continue
+            if await redis_pool.scard(f"{PARTICIPANTS_PREFIX}{message_id}") == reaction.count - (1 if reaction.me else 0): continue # 计数一致，无需分页
+            await reconcile_giveaway_participants(message); reconciled += 1
+        except (nextcord.NotFound, nextcord.Forbidden): continue
+        except Exception as e: log.error(f"对账抽奖 {message_id} 参与者时出错: {e}")
+    if giveaway_ids: log.info(f"参与者对账完成: {len(giveaway_ids)} 个抽奖中 {reconciled} 个计数不一致，已分页回填。")
+
+reconcile_task: asyncio.Task | None = None
+
+def pack_user_ids(user_ids) -> bytes:
+    packed = user_ids if isinstance(user_ids, array.array) else array.array('Q', user_ids)
+    if sys.byteorder == 'big': packed = array.array('Q', packed); packed.byteswap() # 归档格式固定为小端
+    return packed.tobytes()
+
+def unpack_user_ids(packed: bytes | None) -> tuple[int, ...]:
+    if not packed: return ()
+    return struct.unpack(f"<{len(packed) // 8}Q", packed)
+
+async def archive_giveaway_result(message_id: int, giveaway_data: dict, eligible_ids, winner_ids: list[int], creator_avatar_url: str | None = None, draw_seed: int | None = None):
+    # 开奖时归档合格参与者池与获奖者，reroll 直接在本地抽取，无需再请求 Discord
+    if not redis_binary_pool: return
+    try:
+        key = f"{ARCHIVE_PREFIX}{message_id}"; winners_key = f"{ARCHIVE_WINNERS_PREFIX}{message_id}"
+        mapping = {'guild_id': str(giveaway_data['guild_id']), 'channel_id': str(giveaway_data['channel_id']), 'prize': giveaway_data.get('prize', '未知奖品'), 'winners': str(giveaway_data.get('winners', 1)),
+                   'creator_name': giveaway_data.get('creator_name') or '', 'creator_avatar_url': creator_avatar_url or '', 'ended_at': str(int(time.time())), 'pool': pack_user_ids(eligible_ids),
+                   'entry_weights': json.dumps(normalize_entry_weights(giveaway_data.get('entry_weights'))), 'draw_seed': '' if draw_seed is None else str(draw_seed)}
+        async with redis_binary_pool.pipeline(transaction=True) as pipe:
+            pipe.delete(key); pipe.hset(key, mapping=mapping); pipe.expire(key, ARCHIVE_TTL_SECONDS)
+            pipe.set(winners_key, pack_user_ids(winner_ids), ex=ARCHIVE_TTL_SECONDS); pipe.delete(f"{ARCHIVE_SEEDS_PREFIX}{message_id}")
+            await pipe.execute()
+    except Exception as e: log.error(f"归档抽奖 {message_id} 结果时出错: {e}")
+
+async def load_giveaway_archive(message_id: int) -> dict | None:
+    if not redis_binary_pool: return None
+    try:
+        async with redis_binary_pool.pipeline(transaction=False) as pipe:
+            pipe.hgetall(f"{ARCHIVE_PREFIX}{message_id}"); pipe.get(f"{ARCHIVE_WINNERS_PREFIX}{message_id}"); pipe.get(f"{ARCHIVE_SEEDS_PREFIX}{message_id}")
+            raw, past_winners, reroll_seeds = await pipe.execute()
+        if not raw: return None
+        text = {k.decode(): v.decode() for k, v in raw.items() if k != b'pool'}
+        return {'guild_id': int(text['guild_id']), 'channel_id': int(text['channel_id']), 'prize': text.get('prize', '未知奖品'), 'winners': int(text.get('winners', 1)),
+                'creator_name': text.get('creator_name', ''), 'creator_avatar_url': text.get('creator_avatar_url') or None, 'entry_weights': json.loads(text.get('entry_weights') or '{}'), 'pool': unpack_user_ids(raw.get(b'pool')), 'past_winners': unpack_user_ids(past_winners),
+                'draw_seed': int(text['draw_seed']) if text.get('draw_seed') else None, 'reroll_seeds': unpack_user_ids(reroll_seeds)}
+    except Exception as e: log.error(f"从 Redis 加载抽奖 {message_id} 归档时出错: {e}"); return None
+
+async def load_archive_summaries(message_ids: list[int]) -> dict[int, dict]:
+    # 列表用: 只读取归档中的少量文本字段 (不读取参与者池)
+    if not redis_binary_pool or not message_ids: return {}
+    try:
+        async with redis_binary_pool.pipeline(transaction=False) as pipe:
+            for message_id in message_ids: pipe.hmget(f"{ARCHIVE_PREFIX}{message_id}", ['channel_id', 'prize', 'winners'])
+            replies = await pipe.execute()
+        return {message_id: {'channel_id': int(channel_id), 'prize': prize.decode(), 'winners': int(winners or b'1')} for message_id, (channel_id, prize, winners) in zip(message_ids, replies) if channel_id}
+    except Exception as e: log.error(f"从 Redis 批量加载抽奖归档摘要时出错: {e}"); return {}
+
+async def record_archive_winners(message_id: int, winner_ids: list[int], draw_seed: int):
+    # 追加重抽获奖者与本次重抽的种子，便于事后复现每一次抽奖
+    if not redis_binary_pool: return
+    try:
+        seeds_key = f"{ARCHIVE_SEEDS_PREFIX}{message_id}"
+        async with redis_binary_pool.pipeline(transaction=True) as pipe:
+            pipe.append(f"{ARCHIVE_WINNERS_PREFIX}{message_id}", pack_user_ids(winner_ids)); pipe.append(seeds_key, pack_user_ids([draw_seed])); pipe.expire(seeds_key, ARCHIVE_TTL_SECONDS)
+            await pipe.execute()
+    except Exception as e: log.error(f"记录抽奖 {message_id} 重抽获奖者时出错: {e}")
+
+async def acquire_giveaway_leases(message_ids: list[int]) -> list[int]:
+    # 一次流水线为多个抽奖 SET NX 租约，返回成功获取的 ID
+    if not redis_pool or not message_ids: return []
+    try:
+        async with redis_pool.pipeline(transaction=False) as pipe:
+            for message_id in message_ids: pipe.set(f"{GIVEAWAY_LEASE_PREFIX}{message_id}", WORKER_ID, nx=True, ex=GIVEAWAY_LEASE_SECONDS)
+            replies = await pipe.execute()
+        return [message_id for message_id, acquired in zip(message_ids, replies) if acquired]
+    except Exception as e: log.error(f"获取抽奖 {message_ids} 结算租约时出错: {e}"); return []
+
+async def release_giveaway_leases(message_ids: list[int]):
+    if not redis_pool or not message_ids: return
+    try:
+        async with redis_pool.pipeline(transaction=False) as pipe:
+            for message_id in message_ids: pipe.eval(_RELEASE_LEASE_SCRIPT, 1, f"{GIVEAWAY_LEASE_PREFIX}{message_id}", WORKER_ID)
+            await pipe.execute()
+    except Exception as e: log.error(f"释放抽奖 {message_ids} 结算租约时出错: {e}")
+
+async def acquire_giveaway_lease(message_id: int) -> bool:
+    return bool(await acquire_giveaway_leases([message_id]))
+
+async def release_giveaway_lease(message_id: int):
+    await release_giveaway_leases([message_id])
+
+async def claim_giveaway_announcement(message_id: int) -> bool:
+    # 在发送公告前原子地占位: 即使租约过期后被另一进程接手，也最多只会公告一次。
+    # 只有 SET NX 未写入 (已被公告) 时返回 False；Redis 错误向上抛出，调用方保留记录等待下次重试
+    if not redis_pool: return True
+    return await redis_pool.set(f"{GIVEAWAY_ANNOUNCED_PREFIX}{message_id}", WORKER_ID, nx=True, ex=GIVEAWAY_ANNOUNCED_TTL_SECONDS) is not None
+
+def parse_giveaway_targets(text: str) -> tuple[list[int], list[str]]:
+    # 解析以空格/逗号分隔的消息 ID 或消息链接，返回 (消息 ID 列表, 无效项)
+    message_ids = []; invalid = []
+    for token in text.replace(',', ' ').split():
+        candidate = token.rstrip('/').split('/')[-1]
+        if candidate.isdigit(): message_ids.append(int(candidate))
+        else: invalid.append(token)
+    return list(dict.fromkeys(message_ids)), invalid
 
 async def parse_message_link(interaction: nextcord.Interaction, link_or_id: str) -> tuple[int | None, int | None]:
     message_id = None; channel_id = None; guild_id_from_link = None
@@ -102,67 +720,359 @@ async def parse_message_link(interaction: nextcord.Interaction, link_or_id: str)
                     await interaction.followup.send("错误：提供的消息链接来自另一个服务器。", ephemeral=True); return None, None
             except ValueError: await interaction.followup.send("无效的消息链接格式 (ID部分非数字)。", ephemeral=True); return None, None
         else: await interaction.followup.send("请提供格式正确的 Discord 消息链接 (例如: https://discord.com/channels/...).", ephemeral=True); return None, None
-    except Exception as e: await interaction.followup.send(f"解析链接时发生意外错误: {e}", ephemeral=True); print(f"Error parsing link {link_or_id}: {e}"); return None, None
+    except Exception as e: await interaction.followup.send(f"解析链接时发生意外错误: {e}", ephemeral=True); log.error(f"Error parsing link {link_or_id}: {e}"); return None, None
     return channel_id, message_id
 
+# --- 抽奖调度器 (最小堆，精确唤醒) ---
+# 堆中只保存 (end_timestamp, message_id)；_scheduled_end_times 记录每个抽奖的当前有效时间，
+# 被取消或改期的旧堆项在弹出时惰性丢弃。Redis 索引仍是唯一可信来源，定期重新同步。
+_schedule_heap: list[tuple[float, int]] = []
+_scheduled_end_times: dict[int, float] = {}
+_schedule_wakeup = asyncio.Event()
+
+def schedule_giveaway(message_id: int, end_timestamp: float):
+    if _scheduled_end_times.get(message_id) == end_timestamp: return
+    _scheduled_end_times[message_id] = end_timestamp; heapq.heappush(_schedule_heap, (end_timestamp, message_id))
+    if _schedule_heap[0] == (end_timestamp, message_id): _schedule_wakeup.set() # 新的最早期限，唤醒调度器重新计算睡眠时间
+
+def unschedule_giveaway(message_id: int):
+    _scheduled_end_times.pop(message_id, None)
+
+def next_scheduled_time() -> float | None:
+    while _schedule_heap and _scheduled_end_times.get(_schedule_heap[0][1]) != _schedule_heap[0][0]: heapq.heappop(_schedule_heap)
+    return _schedule_heap[0][0] if _schedule_heap else None
+
+def pop_due_scheduled(now: float) -> list[int]:
+    due = []
+    while (next_ts := next_scheduled_time()) is not None and next_ts <= now:
+        _, message_id = heapq.heappop(_schedule_heap); _scheduled_end_times.pop(message_id, None); due.append(message_id)
+    return due
+
+async def resync_schedule(now: float):
+    # 只加载下一个同步窗口内到期的抽奖，更晚的抽奖会在之后的同步中进入堆
+    for message_id, end_timestamp in await get_giveaway_ids_due_before(now + SCHEDULER_RESYNC_SECONDS): schedule_giveaway(message_id, end_timestamp)
+
+async def giveaway_scheduler():
+    await bot.wait_until_ready(); log.info("抽奖调度器已启动。"); last_resync = 0.0
+    while not bot.is_closed():
+        try:
+            now = time.time()
+            if now - last_resync >= SCHEDULER_RESYNC_SECONDS: await resync_schedule(now); last_resync = now
+            next_ts = next_scheduled_time()
+            if next_ts is not None and next_ts <= now:
+                # 到期项统一从 Redis 索引读取；处理失败的抽奖仍留在索引中，下次同步时重试
+                # 结算在后台进行，调度器不被慢速结算阻塞；重叠的周期由 _giveaways_in_progress 去重
+                observe('giveaway_scheduler_lag_seconds', now - next_ts)
+                pop_due_scheduled(now); task = asyncio.create_task(check_giveaways()); _background_tasks.add(task); task.add_done_callback(_background_tasks.discard); continue
+            sleep_for = last_resync + SCHEDULER_RESYNC_SECONDS - now
+            if next_ts is not None: sleep_for = min(sleep_for, next_ts - now)
+            _schedule_wakeup.clear()
+            try: await asyncio.wait_for(_schedule_wakeup.wait(), timeout=max(sleep_for, 0))
+            except asyncio.TimeoutError: pass
+        except asyncio.CancelledError: raise
+        except Exception as e: log.error(f"抽奖调度器出错: {e}"); await asyncio.sleep(1)
+
+giveaway_scheduler_task: asyncio.Task | None = None
+
+# --- 出站消息队列 (按频道合并公告与编辑) ---
+# 获奖公告与 Embed 编辑先写入 Redis，由每个频道的刷新任务在 OUTBOX_WINDOW_SECONDS 窗口结束后统一发送:
+# 同一窗口内的公告合并为尽量少的消息 (每条不超过 2000 字符)，同一消息的多次编辑只发送最后的状态。
+# 内容在发送成功后才从 Redis 删除，进程重启后由 recover_outbox 继续发送。
+DISCORD_MESSAGE_LIMIT = 2000
+EMBED_FIELD_LIMIT = 1024
+EMBED_WINNER_FIELDS = 4
+_outbox_flush_tasks: dict[int, asyncio.Task] = {}
+_outbox_dirty: set[int] = set() # 刷新任务读取队列之后又有新内容写入的频道
+
+def schedule_outbox_flush(channel_id: int, delay: float = OUTBOX_WINDOW_SECONDS):
+    _outbox_dirty.add(channel_id)
+    task = _outbox_flush_tasks.get(channel_id)
+    if task is None or task.done(): _outbox_flush_tasks[channel_id] = asyncio.create_task(run_outbox_flusher(channel_id, delay))
+
+async def run_outbox_flusher(channel_id: int, delay: float):
+    try:
+        while True:
+            await asyncio.sleep(delay); _outbox_dirty.discard(channel_id) # 先清除标记再读取: 之后写入的内容会让本任务再刷新一轮
+            if await flush_channel_outbox(channel_id): delay = OUTBOX_RETRY_SECONDS
+            elif channel_id in _outbox_dirty: delay = OUTBOX_WINDOW_SECONDS
+            else: return
+    finally:
+        if _outbox_flush_tasks.get(channel_id) is asyncio.current_task(): del _outbox_flush_tasks[channel_id]
+
+def split_text(text: str, limit: int, separator: str = ', ') -> list[str]:
+    # 按分隔符切成每段不超过 limit 的片段，不截断单个提及 (单个片段本身超长时才截断)
+    chunks = []
+    for part in text.split(separator):
+        if chunks and len(chunks[-1]) + len(separator) + len(part) <= limit: chunks[-1] += f"{separator}{part}"
+        else: chunks.append(part[:limit])
+    return chunks
+
+def split_message(content: str) -> list[str]:
+    # 超长公告 (大量获奖者) 在换行或 ", " 处拆分为多条消息，每条尽量填满
+    chunks = []
+    for line_no, line in enumerate(content.split('\n')):
+        for part_no, part in enumerate(line.split(', ')):
+            separator = ', ' if part_no else '\n'
+            if chunks and (line_no or part_no) and len(chunks[-1]) + len(separator) + len(part) <= DISCORD_MESSAGE_LIMIT: chunks[-1] += f"{separator}{part}"
+            else: chunks.append(part[:DISCORD_MESSAGE_LIMIT])
+    return chunks
+
+def is_retryable_discord_error(error: Exception) -> bool:
+    # 只有限速、Discord 服务端错误与网络错误值得重试；其他 4xx (如 400 Invalid Form Body) 重试也不会成功
+    if isinstance(error, nextcord.HTTPException): return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+async def enqueue_announcement(channel: nextcord.TextChannel, content: str):
+    chunks = split_message(content)
+    if not redis_pool:
+        for chunk in chunks: await channel.send(chunk, allowed_mentions=nextcord.AllowedMentions(users=True))
+        return
+    try:
+        async with redis_pool.pipeline(transaction=True) as pipe:
+            pipe.rpush(f"{OUTBOX_ANNOUNCE_PREFIX}{channel.id}", *chunks); pipe.sadd(OUTBOX_CHANNELS_KEY, channel.id); await pipe.execute()
+    except Exception as e:
+        log.error(f"写入频道 {channel.id} 公告队列出错: {e}，改为直接发送。")
+        for chunk in chunks: await channel.send(chunk, allowed_mentions=nextcord.AllowedMentions(users=True))
+        return
+    inc_counter('giveaway_outbox_enqueued_total', len(chunks), kind='announce'); schedule_outbox_flush(channel.id)
+
+async def enqueue_embed_edits(edits: list[tuple[nextcord.TextChannel, int, nextcord.Embed, bool]]):
+    # 一次流水线写入多条编辑 (频道, message_id, embed, clear_view)；Redis 不可用时直接编辑
+    if not edits: return
+    if redis_pool:
+        try:
+            async with redis_pool.pipeline(transaction=True) as pipe:
+                for channel, message_id, embed, clear_view in edits:
+                    pipe.hset(f"{OUTBOX_EDITS_PREFIX}{channel.id}", str(message_id), json.dumps({'embed': embed.to_dict(), 'clear_view': clear_view}, ensure_ascii=False)); pipe.sadd(OUTBOX_CHANNELS_KEY, channel.id)
+                await pipe.execute()
+        except Exception as e: log.error(f"写入抽奖 {[message_id for _, message_id, _, _ in edits]} 编辑队列出错: {e}，改为直接编辑。")
+        else:
+            inc_counter('giveaway_outbox_enqueued_total', len(edits), kind='edit')
+            for channel_id in {channel.id for channel, _, _, _ in edits}: schedule_outbox_flush(channel_id)
+            return
+    for channel, message_id, embed, clear_view in edits: await channel.get_partial_message(message_id).edit(embed=embed, **({'view': None} if clear_view else {}))
+
+async def enqueue_embed_edit(channel: nextcord.TextChannel, message_id: int, embed: nextcord.Embed, clear_view: bool = False):
+    await enqueue_embed_edits([(channel, message_id, embed, clear_view)])
+
+def merge_announcements(contents: list[str]) -> list[tuple[str, int]]:
+    # 按原顺序合并为 (消息文本, 包含的公告条数)
+    batches = []
+    for content in contents:
+        if batches and len(batches[-1][0]) + 2 + len(content) <= DISCORD_MESSAGE_LIMIT: batches[-1] = (f"{batches[-1][0]}\n\n{content}", batches[-1][1] + 1)
+        else: batches.append((content, 1))
+    return batches
+
+async def flush_channel_outbox(channel_id: int) -> bool:
+    # 返回 True 表示有内容因可重试的错误 (限速/网络) 未发出，需要稍后重试
+    if not redis_pool: return False
+    announce_key = f"{OUTBOX_ANNOUNCE_PREFIX}{channel_id}"; edits_key = f"{OUTBOX_EDITS_PREFIX}{channel_id}"
+    try:
+        channel = bot.get_channel(channel_id)
+        if channel is None: # 频道已删除 (恢复时只调度本进程可见的频道)，丢弃其待发送内容
+            log.warning(f"频道 {channel_id} 不存在，丢弃其出站队列。"); await redis_pool.delete(announce_key, edits_key); await redis_pool.srem(OUTBOX_CHANNELS_KEY, channel_id); return False
+        async with redis_pool.pipeline(transaction=False) as pipe:
+            pipe.lrange(announce_key, 0, OUTBOX_BATCH_SIZE - 1); pipe.hgetall(edits_key); contents, edits = await pipe.execute()
+        retry = False; sent = 0
+        with timed('giveaway_outbox_flush_seconds'):
+            for text, count in merge_announcements(contents):
+                try: await channel.send(text, allowed_mentions=nextcord.AllowedMentions(users=True))
+                except Exception as e:
+                    if is_retryable_discord_error(e): log.error(f"发送频道 {channel_id} 合并公告出错，稍后重试: {e}"); retry = True; break
+                    log.warning(f"无法在频道 {channel_id} 发送公告，丢弃 {count} 条: {e}"); inc_counter('giveaway_outbox_dropped_total', count, kind='announce')
+                else: inc_counter('giveaway_outbox_messages_total', kind='announce')
+                sent += count
+            if sent: await redis_pool.ltrim(announce_key, sent, -1); inc_counter('giveaway_outbox_items_total', sent, kind='announce') # 其他进程只会追加，按条数裁掉已发送的前缀
+            for message_id, payload in edits.items():
+                if retry: break
+                try:
+                    state = json.loads(payload); edit_kwargs = {'embed': nextcord.Embed.from_dict(state['embed'])}
+                    if state.get('clear_view'): edit_kwargs['view'] = None
+                    await channel.get_partial_message(int(message_id)).edit(**edit_kwargs) # 无需 fetch_message
+                except Exception as e:
+                    if is_retryable_discord_error(e): log.error(f"编辑抽奖 {message_id} 消息出错，稍后重试: {e}"); retry = True; break
+                    log.warning(f"无法编辑抽奖 {message_id} 消息，丢弃: {e}"); inc_counter('giveaway_outbox_dropped_total', kind='edit')
+                else: inc_counter('giveaway_outbox_messages_total', kind='edit')
+                await redis_pool.eval(_OUTBOX_ACK_EDIT_SCRIPT, 1, edits_key, message_id, payload); inc_counter('giveaway_outbox_items_total', kind='edit')
+        if not retry and not await redis_pool.eval(_OUTBOX_CLEANUP_SCRIPT, 3, announce_key, edits_key, OUTBOX_CHANNELS_KEY, channel_id): _outbox_dirty.add(channel_id) # 超过单批上限或有新写入，继续刷新
+        return retry
+    except Exception as e: log.error(f"刷新频道 {channel_id} 出站队列出错: {e}"); return True
+
+async def recover_outbox():
+    # 重启后继续发送本进程可见频道中未完成的公告与编辑
+    if not redis_pool: return
+    try: channel_ids = [int(channel_id) for channel_id in await redis_pool.smembers(OUTBOX_CHANNELS_KEY)]
+    except Exception as e: log.error(f"读取出站队列频道列表出错: {e}"); return
+    pending = [channel_id for channel_id in channel_ids if bot.get_channel(channel_id)]
+    for channel_id in pending: schedule_outbox_flush(channel_id, delay=0)
+    if pending: log.info(f"恢复 {len(pending)} 个频道的待发送公告/编辑。")
+
 # --- 科技感 Embed 消息函数 (包含 SyntaxError 修正) ---
-def create_giveaway_embed(prize: str, end_time: datetime.datetime, winners: int, creator: nextcord.User | nextcord.Member, required_role: nextcord.Role | None, status: str = "running"):
+GIVEAWAY_THUMBNAIL_URL = "https://cdn.discordapp.com/attachments/1003591315297738772/1198117400949297172/giveaway-box.png?ex=65bda71e&is=65ab321e&hm=375f317989609026891610d51d14116503d730ffb1ed1f8749f8e8215e911c18&"
+
+def create_giveaway_embed(prize: str, end_time: datetime.datetime, winners: int, creator: nextcord.User | nextcord.Member, required_roles: list[nextcord.Role] | None, status: str = "running", required_role_mode: str = "any", blacklisted_roles: list[nextcord.Role] | None = None, bonus_roles: list[tuple[nextcord.Role, int]] | None = None):
     embed=nextcord.Embed(title="<a:_:1198114874891632690> **赛博抽奖进行中!** <a:_:1198114874891632690>", description=f"点击 🎉 表情参与!\n\n**奖品:** `{prize}`", color=0x00FFFF)
     embed.add_field(name="<:timer:1198115585629569044> 结束于", value=f"<t:{int(end_time.timestamp())}:R>", inline=True)
     embed.add_field(name="<:winner:1198115869403988039> 获奖人数", value=f"`{winners}`", inline=True)
     # --- 修正后的 if/else 块 ---
-    if required_role:
-        embed.add_field(name="<:requirement:1198116280151654461> 参与条件", value=f"需要拥有 {required_role.mention} 身份组。", inline=False)
+    requirement_lines = []
+    if required_roles:
+        role_mentions = "、".join(r.mention for r in required_roles)
+        requirement_lines.append(f"需要拥有 {role_mentions} 身份组。" if len(required_roles) == 1 else f"需要拥有 {role_mentions} 中的{'全部' if required_role_mode == 'all' else '任意一个'}身份组。")
+    if blacklisted_roles: requirement_lines.append(f"拥有 {'、'.join(r.mention for r in blacklisted_roles)} 身份组者不可参与。")
+    if requirement_lines:
+        embed.add_field(name="<:requirement:1198116280151654461> 参与条件", value="\n".join(requirement_lines), inline=False)
     else:
         embed.add_field(name="<:requirement:1198116280151654461> 参与条件", value="`无`", inline=False)
     # --- 修正结束 ---
+    if bonus_roles: embed.add_field(name="🎟️ 额外抽奖次数", value="\n".join(f"{role.mention}: `{entries}` 次" for role, entries in bonus_roles), inline=False)
     embed.set_footer(text=f"由 {creator.display_name} 发起 | 状态: {status.upper()}", icon_url=creator.display_avatar.url if creator.display_avatar else None)
-    embed.set_thumbnail(url="https://cdn.discordapp.com/attachments/1003591315297738772/1198117400949297172/giveaway-box.png?ex=65bda71e&is=65ab321e&hm=375f317989609026891610d51d14116503d730ffb1ed1f8749f8e8215e911c18&")
+    embed.set_thumbnail(url=GIVEAWAY_THUMBNAIL_URL)
+    return embed
+
+def create_cancelled_embed(giveaway_data: dict) -> nextcord.Embed:
+    embed = nextcord.Embed(title="<:cross:1198118636147118171> **抽奖已取消** <:cross:1198118636147118171>", description=f"**奖品:** `{giveaway_data.get('prize', '未知奖品')}`\n\n本次抽奖已被管理员取消。", color=0x36393F)
+    embed.set_thumbnail(url=GIVEAWAY_THUMBNAIL_URL); embed.set_footer(text=f"由 {giveaway_data.get('creator_name') or '未知'} 发起 | 状态: 已取消")
+    return embed
+
+def create_archived_embed(archive: dict) -> nextcord.Embed:
+    # 根据归档重建已结束的 Embed (reroll 时无需 fetch_message)，之后交给 update_embed_ended 填充
+    embed = nextcord.Embed(); embed.set_thumbnail(url=GIVEAWAY_THUMBNAIL_URL)
+    embed.set_footer(text=f"由 {archive['creator_name']} 发起 | 状态: 已结束", icon_url=archive['creator_avatar_url'])
     return embed
 
 def update_embed_ended(embed: nextcord.Embed, winner_mentions: str | None, prize: str, participant_count: int):
      embed.title="<:check:1198118533916270644> **抽奖已结束** <:check:1198118533916270644>"; embed.color=0x36393F; embed.clear_fields();
-     if winner_mentions: embed.description=f"**奖品:** `{prize}`\n\n恭喜以下获奖者！"; embed.add_field(name="<:winner:1198115869403988039> 获奖者", value=winner_mentions, inline=False);
+     if winner_mentions:
+         embed.description=f"**奖品:** `{prize}`\n\n恭喜以下获奖者！"
+         # 单个字段上限 1024 字符: 获奖者按 ", " 分到多个字段，最多 EMBED_WINNER_FIELDS 个 (Embed 总长度上限 6000)，其余只显示人数
+         chunks = split_text(winner_mentions, EMBED_FIELD_LIMIT - 32); shown = chunks[:EMBED_WINNER_FIELDS]
+         if len(chunks) > len(shown): shown[-1] += f"\n… 另有 {sum(chunk.count(', ') + 1 for chunk in chunks[len(shown):])} 位获奖者"
+         for i, chunk in enumerate(shown): embed.add_field(name="<:winner:1198115869403988039> 获奖者" + (" (续)" if i else ""), value=chunk, inline=False);
      else: embed.description=f"**奖品:** `{prize}`\n\n本次抽奖没有符合条件的参与者。"; embed.add_field(name="<:cross:1198118636147118171> 获奖者", value="`无`", inline=False);
      embed.add_field(name="<:members:1198118814719295550> 参与人数", value=f"`{participant_count}`", inline=True);
      if embed.footer: original_footer_text=embed.footer.text.split('|')[0].strip(); embed.set_footer(text=f"{original_footer_text} | 状态: 已结束", icon_url=embed.footer.icon_url);
      return embed
 
+# --- 身份组 -> 成员 ID 索引 ---
+# 资格筛选以成员 ID 集合求交/差完成，无需遍历每个参与者的身份组列表。
+# 索引按服务器懒构建 (一次遍历成员缓存)，之后由 on_member_update/on_member_remove 等事件增量维护。
+_role_member_index: dict[int, dict[int, set[int]]] = {}
+
+def get_role_member_ids(guild: nextcord.Guild, role_id: int) -> set[int]:
+    index = _role_member_index.get(guild.id)
+    if index is None:
+        index = collections.defaultdict(set)
+        for member in guild.members:
+            for role in member.roles: index[role.id].add(member.id)
+        if not guild.chunked: return index.get(role_id, set()) # 成员缓存尚未完整，不缓存不完整的索引
+        _role_member_index[guild.id] = index
+    return index.get(role_id, set())
+
+def index_member_roles(member: nextcord.Member, role_ids: set[int], add: bool):
+    index = _role_member_index.get(member.guild.id)
+    if index is None: return
+    for role_id in role_ids:
+        if add: index.setdefault(role_id, set()).add(member.id)
+        elif role_id in index: index[role_id].discard(member.id)
+
+def get_giveaway_role_rules(giveaway_data: dict) -> tuple[list[int], str, list[int]]:
+    required_role_ids = giveaway_data.get('required_role_ids')
+    if required_role_ids is None: required_role_ids = [giveaway_data['required_role_id']] if giveaway_data.get('required_role_id') else [] # 兼容旧数据
+    return required_role_ids, giveaway_data.get('required_role_mode') or 'any', giveaway_data.get('blacklisted_role_ids') or []
+
+def make_eligibility_fn(guild: nextcord.Guild, giveaway_data: dict):
+    # 逐个 ID 判断资格，参与者可以流式检查: 每个条件只是一次对身份组索引集合的成员查询
+    required_role_ids, required_role_mode, blacklisted_role_ids = get_giveaway_role_rules(giveaway_data)
+    # 已离开服务器的用户不计入参与人数与归档池: @everyone 身份组 (ID 等于服务器 ID) 的成员即当前全部成员。
+    # 成员缓存不完整时无法判断，保留这些用户，抽中后由 pick_winner_members 跳过
+    member_ids = get_role_member_ids(guild, guild.id) if guild.chunked else None
+    required_sets = sorted((get_role_member_ids(guild, role_id) for role_id in required_role_ids if guild.get_role(role_id)), key=len) # 已删除的身份组不再作为条件
+    blacklisted_sets = [get_role_member_ids(guild, role_id) for role_id in blacklisted_role_ids if guild.get_role(role_id)]
+    match_required = all if required_role_mode == 'all' else any
+    def is_eligible(user_id: int) -> bool:
+        if member_ids is not None and user_id not in member_ids: return False
+        if required_sets and not match_required(user_id in role_member_ids for role_member_ids in required_sets): return False
+        return not any(user_id in role_member_ids for role_member_ids in blacklisted_sets)
+    return is_eligible
+
+def filter_eligible_participant_ids(guild: nextcord.Guild, participant_ids, giveaway_data: dict) -> set[int]:
+    is_eligible = make_eligibility_fn(guild, giveaway_data)
+    return {user_id for user_id in participant_ids if is_eligible(user_id)}
+
+# --- 加权抽奖 (单遍加权水库抽样) ---
+# Efraimidis-Spirakis A-ES: 每个参与者的键为 log(u) / weight，取键最大的 k 个；抽样只维护大小为 k 的最小堆，额外内存 O(k)。
+# 合格参与者池本身仍需完整保留 (归档供 reroll 使用)，开奖时以 8 字节/ID 的紧凑数组存放，见 scan_eligible_participant_ids。
+# u 由 (seed, user_id) 哈希得出而非顺序随机数，因此结果与遍历顺序无关，公开 seed 即可复现抽奖结果。
+def draw_uniform(seed: int, user_id: int) -> float:
+    digest = hashlib.blake2b(struct.pack("<QQ", seed, user_id), digest_size=8).digest()
+    return (int.from_bytes(digest, 'little') + 1) / (2 ** 64 + 1) # 落在开区间 (0, 1)
+
+def weighted_reservoir_sample(user_ids, count: int, seed: int, weight_of) -> list[int]:
+    reservoir: list[tuple[float, int]] = []; chosen = set() # 同一 ID 的键相同: 重复出现时只需跳过已在堆中的 ID
+    for user_id in user_ids:
+        if user_id in chosen: continue
+        weight = weight_of(user_id)
+        if weight <= 0: continue
+        key = math.log(draw_uniform(seed, user_id)) / weight
+        if len(reservoir) < count: heapq.heappush(reservoir, (key, user_id)); chosen.add(user_id)
+        elif key > reservoir[0][0]: chosen.discard(heapq.heapreplace(reservoir, (key, user_id))[1]); chosen.add(user_id)
+    return [user_id for _, user_id in sorted(reservoir, reverse=True)]
+
+def normalize_entry_weights(entry_weights: dict | None) -> dict[int, int]:
+    return {int(role_id): int(entries) for role_id, entries in (entry_weights or {}).items() if int(entries) > 1}
+
+def make_entry_weight_fn(guild: nextcord.Guild, entry_weights: dict | None):
+    # 拥有多个加成身份组时取最高的抽奖次数，没有加成时为 1
+    bonus_sets = [(get_role_member_ids(guild, role_id), entries) for role_id, entries in sorted(normalize_entry_weights(entry_weights).items(), key=lambda item: -item[1]) if guild.get_role(role_id)]
+    if not bonus_sets: return lambda user_id: 1
+    def weight_of(user_id: int) -> int:
+        return next((entries for member_ids, entries in bonus_sets if user_id in member_ids), 1)
+    return weight_of
+
+def pick_winner_members(guild: nextcord.Guild, candidate_ids, count: int, entry_weights: dict | None = None, seed: int | None = None, exclude: set[int] = frozenset()) -> tuple[list[nextcord.Member], int]:
+    # 返回 (获奖成员, seed)。单遍抽取: 不在成员缓存中 (已离开服务器) 的用户在遍历时直接跳过，
+    # 结果与"抽中后排除再用同一 seed 继续抽取"相同，但无需多次遍历参与者池
+    seed = secrets.randbits(63) if seed is None else seed; weight_of = make_entry_weight_fn(guild, entry_weights)
+    picks = weighted_reservoir_sample((user_id for user_id in candidate_ids if user_id not in exclude and guild.get_member(user_id)), count, seed, weight_of)
+    return [guild.get_member(user_id) for user_id in picks], seed
+
 # --- 核心开奖逻辑函数 ---
 async def process_giveaway_end(message: nextcord.Message, giveaway_data: dict):
     guild = message.guild; channel = message.channel; bot_instance = bot
-    if not guild or not channel or not isinstance(channel, nextcord.TextChannel): print(f"错误: process_giveaway_end 参数无效 (消息 ID: {message.id})"); return
-    print(f"正在处理抽奖结束: {message.id} (奖品: {giveaway_data.get('prize', 'N/A')})")
-    reaction = nextcord.utils.get(message.reactions, emoji="🎉"); potential_participants = []
-    if reaction:
-        try: potential_participants = [m async for m in reaction.users() if isinstance(m, nextcord.Member)]
-        except nextcord.Forbidden: print(f"无法获取消息 {message.id} 反应者 (权限不足?)。")
-        except Exception as e: print(f"获取抽奖 {message.id} 反应用户出错: {e}。")
-    else: print(f"消息 {message.id} 无 🎉 反应。")
-    eligible_participants = []; required_role_id = giveaway_data.get('required_role_id'); required_role = None
-    if required_role_id: required_role = guild.get_role(required_role_id)
-    if required_role: eligible_participants = [m for m in potential_participants if required_role in m.roles]
-    else: eligible_participants = potential_participants
-    winners = []; winner_mentions = None; participant_count = len(eligible_participants)
-    if eligible_participants:
-        num_winners = min(giveaway_data['winners'], len(eligible_participants))
-        if num_winners > 0: winners = random.sample(eligible_participants, num_winners); winner_mentions = ", ".join([w.mention for w in winners]); print(f"抽奖 {message.id} 获胜者: {[w.name for w in winners]}")
+    if not guild or not channel or not isinstance(channel, nextcord.TextChannel): log.error(f"错误: process_giveaway_end 参数无效 (消息 ID: {message.id})"); return
+    log.info(f"正在处理抽奖结束: {message.id} (奖品: {giveaway_data.get('prize', 'N/A')})")
+    eligible_ids = array.array('Q')
+    try: eligible_ids = await scan_eligible_participant_ids(message, giveaway_data)
+    except nextcord.Forbidden: log.warning(f"无法获取消息 {message.id} 反应者 (权限不足?)。")
+    except Exception as e: log.error(f"获取抽奖 {message.id} 参与者出错: {e}。")
+    if not eligible_ids: log.info(f"消息 {message.id} 无合格的 🎉 参与者。")
+    winners = []; winner_mentions = None; participant_count = len(eligible_ids); draw_seed = None
+    if eligible_ids and giveaway_data['winners'] > 0:
+        winners, draw_seed = pick_winner_members(guild, eligible_ids, giveaway_data['winners'], giveaway_data.get('entry_weights'))
+        if winners: winner_mentions = ", ".join([w.mention for w in winners]); log.info(f"抽奖 {message.id} 获胜者: {[w.name for w in winners]} (seed={draw_seed})")
+    if not await claim_giveaway_announcement(message.id): log.warning(f"抽奖 {message.id} 已由其他进程公告，跳过。"); return
+    creator_avatar_url = message.embeds[0].footer.icon_url if message.embeds and message.embeds[0].footer else None
+    await archive_giveaway_result(message.id, giveaway_data, eligible_ids, [w.id for w in winners], creator_avatar_url, draw_seed)
     result_message = f"<a:_:1198114874891632690> **抽奖结束！** <...>\n奖品: `{giveaway_data['prize']}`\n";
-    if winner_mentions: result_message += f"\n恭喜 {winner_mentions}！"
+    if winner_mentions: result_message += f"\n恭喜 {winner_mentions}！\n-# 抽奖种子: `{draw_seed}`"
     else: result_message += "\n可惜，本次抽奖没有符合条件的获奖者。"
-    try: await channel.send(result_message, allowed_mentions=nextcord.AllowedMentions(users=True))
-    except Exception as e: print(f"发送抽奖 {message.id} 获奖公告出错: {e}")
+    try: await enqueue_announcement(channel, result_message)
+    except Exception as e: log.error(f"发送抽奖 {message.id} 获奖公告出错: {e}")
     if message.embeds:
-        try: updated_embed = update_embed_ended(message.embeds[0], winner_mentions, giveaway_data['prize'], participant_count); await message.edit(embed=updated_embed, view=None)
-        except Exception as e: print(f"编辑抽奖 {message.id} 消息出错: {e}")
-    else: print(f"抽奖 {message.id} 无 Embed 可更新。")
+        try: updated_embed = update_embed_ended(message.embeds[0], winner_mentions, giveaway_data['prize'], participant_count); await enqueue_embed_edit(channel, message.id, updated_embed, clear_view=True)
+        except Exception as e: log.error(f"编辑抽奖 {message.id} 消息出错: {e}")
+    else: log.info(f"抽奖 {message.id} 无 Embed 可更新。")
 
 # --- 抽奖命令 ---
 @bot.slash_command(name="giveaway", description="抽奖活动管理基础命令")
 async def giveaway(interaction: nextcord.Interaction): pass
 
 @giveaway.subcommand(name="create", description="🎉 发起一个新的抽奖活动！")
-async def giveaway_create(interaction: nextcord.Interaction, duration: str = ..., winners: int = ..., prize: str = ..., channel: nextcord.abc.GuildChannel = None, required_role: nextcord.Role = None):
+@instrumented_command("create")
+async def giveaway_create(interaction: nextcord.Interaction, duration: str = ..., winners: int = ..., prize: str = ..., channel: nextcord.abc.GuildChannel = None, required_role: nextcord.Role = None, required_role_2: nextcord.Role = None,
+                          required_role_mode: str = nextcord.SlashOption(description="有多个参与条件身份组时: 任意一个/全部", choices={"任意一个": "any", "全部": "all"}, required=False, default="any"), blacklisted_role: nextcord.Role = None,
+                          bonus_role: nextcord.Role = None, bonus_entries: int = nextcord.SlashOption(description="加成身份组成员的抽奖次数 (默认 2)", required=False, default=2, min_value=2, max_value=100)):
     await interaction.response.defer(ephemeral=True); target_channel = channel or interaction.channel
     if not isinstance(target_channel, nextcord.TextChannel): await interaction.followup.send("错误: 非文字频道。", ephemeral=True); return
     bot_member=interaction.guild.me; permissions=target_channel.permissions_for(bot_member); required_perms={"send_messages": permissions.send_messages, "embed_links": permissions.embed_links, "add_reactions": permissions.add_reactions, "read_message_history": permissions.read_message_history, "manage_messages": permissions.manage_messages}; missing_perms=[p for p,h in required_perms.items() if not h]
@@ -170,55 +1080,79 @@ async def giveaway_create(interaction: nextcord.Interaction, duration: str = ...
     delta=parse_duration(duration);
     if delta is None or delta.total_seconds() <= 5: await interaction.followup.send("无效时长。", ephemeral=True); return
     if winners <= 0: await interaction.followup.send("获奖人数需>=1。", ephemeral=True); return
-    end_time=datetime.datetime.now(datetime.timezone.utc) + delta; embed=create_giveaway_embed(prize, end_time, winners, interaction.user, required_role)
-    try: giveaway_message = await target_channel.send(embed=embed); await giveaway_message.add_reaction("🎉")
-    except Exception as e: await interaction.followup.send(f"创建抽奖出错: {e}", ephemeral=True); print(f"Error creating giveaway: {e}"); return
-    giveaway_data={'guild_id': interaction.guild.id, 'channel_id': target_channel.id, 'message_id': giveaway_message.id, 'end_time': end_time, 'winners': winners, 'prize': prize, 'required_role_id': required_role.id if required_role else None, 'creator_id': interaction.user.id, 'creator_name': interaction.user.display_name}
+    required_roles = [r for r in (required_role, required_role_2) if r]; blacklisted_roles = [blacklisted_role] if blacklisted_role else []; bonus_roles = [(bonus_role, bonus_entries)] if bonus_role else []
+    end_time=datetime.datetime.now(datetime.timezone.utc) + delta; embed=create_giveaway_embed(prize, end_time, winners, interaction.user, required_roles, required_role_mode=required_role_mode, blacklisted_roles=blacklisted_roles, bonus_roles=bonus_roles)
+    try: giveaway_message = await target_channel.send(embed=embed); await giveaway_message.add_reaction(GIVEAWAY_EMOJI)
+    except Exception as e: await interaction.followup.send(f"创建抽奖出错: {e}", ephemeral=True); log.error(f"Error creating giveaway: {e}"); return
+    giveaway_data={'guild_id': interaction.guild.id, 'channel_id': target_channel.id, 'message_id': giveaway_message.id, 'end_time': end_time, 'winners': winners, 'prize': prize, 'required_role_id': required_roles[0].id if required_roles else None, 'required_role_ids': [r.id for r in required_roles], 'required_role_mode': required_role_mode, 'blacklisted_role_ids': [r.id for r in blacklisted_roles], 'entry_weights': {str(r.id): n for r, n in bonus_roles} or None, 'creator_id': interaction.user.id, 'creator_name': interaction.user.display_name}
     await save_giveaway_data(giveaway_message.id, giveaway_data)
     await interaction.followup.send(f"✅ `{prize}` 抽奖已在 {target_channel.mention} 创建！结束于: <t:{int(end_time.timestamp())}:F>", ephemeral=True)
 
+async def reroll_from_archive(interaction: nextcord.Interaction, message_id: int, archive: dict):
+    target_channel = bot.get_channel(archive['channel_id'])
+    if not target_channel: await interaction.followup.send("错误：无法找到抽奖所在的频道。", ephemeral=True); return
+    prize = archive['prize']; past_winners = set(archive['past_winners']) # 排除历史获奖者
+    if not set(archive['pool']) - past_winners: await interaction.followup.send("所有合格参与者均已中奖，无人可重抽。", ephemeral=True); return
+    if archive['winners'] <= 0: await interaction.followup.send("无法重抽0位。", ephemeral=True); return
+    new_winners, draw_seed = pick_winner_members(interaction.guild, archive['pool'], archive['winners'], archive['entry_weights'], exclude=past_winners)
+    if not new_winners: await interaction.followup.send("无符合条件的参与者可重抽。", ephemeral=True); return
+    await record_archive_winners(message_id, [w.id for w in new_winners], draw_seed)
+    log.info(f"抽奖 {message_id} 重抽获胜者: {[w.name for w in new_winners]} (seed={draw_seed}, 此前种子: {[archive['draw_seed'], *archive['reroll_seeds']]})")
+    new_winner_mentions = ", ".join([w.mention for w in new_winners])
+    await enqueue_announcement(target_channel, f"<:reroll:1198121147395555328> **重新抽奖！** <...>\n恭喜 `{prize}` 的新获奖者: {new_winner_mentions}\n-# 抽奖种子: `{draw_seed}`")
+    try: updated_embed = update_embed_ended(create_archived_embed(archive), new_winner_mentions, prize, len(archive['pool'])); await enqueue_embed_edit(target_channel, message_id, updated_embed)
+    except Exception as e: log.error(f"Error edit msg after reroll {message_id}: {e}")
+    await interaction.followup.send(f"✅ 已为 `{prize}` 重抽。新获奖者: {new_winner_mentions}", ephemeral=True)
+
 @giveaway.subcommand(name="reroll", description="<:reroll:1198121147395555328> 重新抽取获胜者。")
 @commands.has_permissions(manage_guild=True)
+@instrumented_command("reroll")
 async def giveaway_reroll(interaction: nextcord.Interaction, message_link_or_id: str = ...):
     await interaction.response.defer(ephemeral=True)
     channel_id, message_id = await parse_message_link(interaction, message_link_or_id)
     if channel_id is None or message_id is None: return
+    archive = await load_giveaway_archive(message_id)
+    if archive and archive['guild_id'] == interaction.guild.id: await reroll_from_archive(interaction, message_id, archive); return
+    log.info(f"抽奖 {message_id} 无归档快照，回退到从消息反应重抽。")
     target_channel = bot.get_channel(channel_id)
     if not target_channel: await interaction.followup.send("错误：无法找到链接中的频道。", ephemeral=True); return
     try: message = await target_channel.fetch_message(message_id)
     except nextcord.NotFound: await interaction.followup.send("无法找到原始抽奖消息。", ephemeral=True); return
     except nextcord.Forbidden: await interaction.followup.send(f"无权限在 {target_channel.mention} 读取历史记录。", ephemeral=True); return
-    except Exception as e: await interaction.followup.send(f"获取消息时出错: {e}", ephemeral=True); print(f"Error fetch msg reroll {message_id}: {e}"); return
+    except Exception as e: await interaction.followup.send(f"获取消息时出错: {e}", ephemeral=True); log.error(f"Error fetch msg reroll {message_id}: {e}"); return
     if not message.embeds: await interaction.followup.send("消息缺少 Embed。", ephemeral=True); return
     original_embed = message.embeds[0]
-    giveaway_data = await load_giveaway_data(message_id); prize = "未知奖品"; winners_count = 1; required_role_id = None
-    if giveaway_data: print(f"Reroll {message_id} using Redis data"); winners_count=giveaway_data.get('winners',1); required_role_id=giveaway_data.get('required_role_id'); prize=giveaway_data.get('prize', prize)
-    else: print(f"Warn: No Redis data for {message_id}, parsing embed for reroll."); # ... (Fallback embed parsing logic as before) ...
-    reaction = nextcord.utils.get(message.reactions, emoji="🎉")
-    if reaction is None: await interaction.followup.send("消息上无 🎉 反应。", ephemeral=True); return
-    try: potential_participants = [m async for m in reaction.users() if isinstance(m, nextcord.Member)]
+    giveaway_data = await load_giveaway_data(message_id); prize = "未知奖品"; winners_count = 1
+    if giveaway_data: log.info(f"Reroll {message_id} using Redis data"); winners_count=giveaway_data.get('winners',1); prize=giveaway_data.get('prize', prize)
+    else: log.warning(f"Warn: No Redis data for {message_id}, parsing embed for reroll."); # ... (Fallback embed parsing logic as before) ...
+    try: participant_ids = await get_giveaway_participant_ids(message)
     except nextcord.Forbidden: await interaction.followup.send("错误: 需要成员意图权限。", ephemeral=True); return
-    except Exception as e: await interaction.followup.send(f"获取反应用户出错: {e}", ephemeral=True); print(f"Error react users reroll {message_id}: {e}"); return
-    eligible_participants = []; required_role = None
-    if required_role_id: required_role = interaction.guild.get_role(required_role_id)
-    if required_role: print(f"Reroll filtering for role: {required_role.name}"); eligible_participants = [m for m in potential_participants if required_role in m.roles]
-    else: eligible_participants = potential_participants
-    if not eligible_participants: await interaction.followup.send("无符合条件的参与者可重抽。", ephemeral=True); await target_channel.send(f"尝试为 `{prize}` 重抽，但无合格参与者。"); return
-    num_to_reroll = min(winners_count, len(eligible_participants))
-    if num_to_reroll <= 0: await interaction.followup.send("无法重抽0位。", ephemeral=True); return
-    new_winners = random.sample(eligible_participants, num_to_reroll); new_winner_mentions = ", ".join([w.mention for w in new_winners])
-    await target_channel.send(f"<:reroll:1198121147395555328> **重新抽奖！** <...>\n恭喜 `{prize}` 的新获奖者: {new_winner_mentions}", allowed_mentions=nextcord.AllowedMentions(users=True))
-    try: updated_embed = update_embed_ended(original_embed, new_winner_mentions, prize, len(eligible_participants)); await message.edit(embed=updated_embed)
-    except Exception as e: print(f"Error edit msg after reroll {message_id}: {e}")
+    except Exception as e: await interaction.followup.send(f"获取参与者出错: {e}", ephemeral=True); log.error(f"Error participants reroll {message_id}: {e}"); return
+    if not participant_ids: await interaction.followup.send("消息上无 🎉 反应。", ephemeral=True); return
+    eligible_ids = filter_eligible_participant_ids(interaction.guild, participant_ids, giveaway_data or {})
+    if not eligible_ids: await interaction.followup.send("无符合条件的参与者可重抽。", ephemeral=True); await enqueue_announcement(target_channel, f"尝试为 `{prize}` 重抽，但无合格参与者。"); return
+    if winners_count <= 0: await interaction.followup.send("无法重抽0位。", ephemeral=True); return
+    new_winners, draw_seed = pick_winner_members(interaction.guild, eligible_ids, winners_count, (giveaway_data or {}).get('entry_weights'))
+    if not new_winners: await interaction.followup.send("无符合条件的参与者可重抽。", ephemeral=True); return
+    new_winner_mentions = ", ".join([w.mention for w in new_winners])
+    log.info(f"抽奖 {message_id} 重抽获胜者: {[w.name for w in new_winners]} (seed={draw_seed})")
+    # 为旧抽奖补建归档 (以本次重抽为准)，之后的 reroll 走归档路径并排除本次获奖者
+    creator_name = original_embed.footer.text.split('|')[0].strip().removeprefix('由 ').removesuffix(' 发起') if original_embed.footer and original_embed.footer.text else ''
+    await archive_giveaway_result(message_id, {'guild_id': interaction.guild.id, 'channel_id': channel_id, 'prize': prize, 'winners': winners_count, 'creator_name': creator_name, 'entry_weights': (giveaway_data or {}).get('entry_weights')},
+                                  eligible_ids, [w.id for w in new_winners], original_embed.footer.icon_url if original_embed.footer else None, draw_seed)
+    await enqueue_announcement(target_channel, f"<:reroll:1198121147395555328> **重新抽奖！** <...>\n恭喜 `{prize}` 的新获奖者: {new_winner_mentions}\n-# 抽奖种子: `{draw_seed}`")
+    try: updated_embed = update_embed_ended(original_embed, new_winner_mentions, prize, len(eligible_ids)); await enqueue_embed_edit(target_channel, message_id, updated_embed)
+    except Exception as e: log.error(f"Error edit msg after reroll {message_id}: {e}")
     await interaction.followup.send(f"✅ 已为 `{prize}` 重抽。新获奖者: {new_winner_mentions}", ephemeral=True)
 
 @giveaway_reroll.error
 async def reroll_error(interaction: nextcord.Interaction, error):
     if isinstance(error, commands.MissingPermissions): await interaction.response.send_message("抱歉，你没有权限执行此命令。", ephemeral=True)
-    else: await interaction.response.send_message(f"执行 reroll 命令出错: {error}", ephemeral=True); print(f"Error in reroll cmd: {error}")
+    else: await interaction.response.send_message(f"执行 reroll 命令出错: {error}", ephemeral=True); log.error(f"Error in reroll cmd: {error}")
 
 @giveaway.subcommand(name="pickwinner", description="👑 [管理员] 手动指定中奖者并结束抽奖。")
 @commands.has_permissions(manage_guild=True)
+@instrumented_command("pickwinner")
 async def giveaway_pickwinner(interaction: nextcord.Interaction, message_link_or_id: str = ..., winner1: nextcord.Member = ..., winner2: nextcord.Member = None, winner3: nextcord.Member = None):
     await interaction.response.defer(ephemeral=True)
     channel_id, message_id = await parse_message_link(interaction, message_link_or_id)
@@ -228,40 +1162,50 @@ async def giveaway_pickwinner(interaction: nextcord.Interaction, message_link_or
     try: message = await target_channel.fetch_message(message_id)
     except nextcord.NotFound: await interaction.followup.send("无法找到原始抽奖消息。", ephemeral=True); return
     except nextcord.Forbidden: await interaction.followup.send(f"无权限在 {target_channel.mention} 读取历史记录。", ephemeral=True); return
-    except Exception as e: await interaction.followup.send(f"获取消息时出错: {e}", ephemeral=True); print(f"Error fetch msg pickwinner {message_id}: {e}"); return
+    except Exception as e: await interaction.followup.send(f"获取消息时出错: {e}", ephemeral=True); log.error(f"Error fetch msg pickwinner {message_id}: {e}"); return
     if not message.embeds: await interaction.followup.send("消息缺少 Embed。", ephemeral=True); return
     original_embed = message.embeds[0]; giveaway_data = await load_giveaway_data(message_id); prize = "未知奖品"
     if giveaway_data: prize = giveaway_data.get('prize', prize)
     else:
-        print(f"无法从 Redis 加载抽奖 {message_id} 数据 (pickwinner), 尝试从 Embed 解析奖品...")
+        log.warning(f"无法从 Redis 加载抽奖 {message_id} 数据 (pickwinner), 尝试从 Embed 解析奖品...")
         if original_embed.description:
             prize_line = next((line for line in original_embed.description.split('\n') if line.lower().strip().startswith('**prize:**')), None)
             if prize_line:
-                try: prize = prize_line.split('`')[1]; print(f"从 Embed 解析到奖品: {prize}")
-                except IndexError: print("从 Embed 解析奖品失败: 格式不匹配或缺少反引号。"); pass
+                try: prize = prize_line.split('`')[1]; log.info(f"从 Embed 解析到奖品: {prize}")
+                except IndexError: log.warning("从 Embed 解析奖品失败: 格式不匹配或缺少反引号。"); pass
     specified_winners = [w for w in [winner1, winner2, winner3] if w is not None]
     if not specified_winners: await interaction.followup.send("错误：必须至少指定一位中奖者。", ephemeral=True); return
     winner_mentions = ", ".join([w.mention for w in specified_winners])
     result_message = f"👑 **抽奖结果指定！** 👑\n奖品: `{prize}`\n\n管理员指定以下用户为中奖者: {winner_mentions}"
-    try: await target_channel.send(result_message, allowed_mentions=nextcord.AllowedMentions(users=True))
-    except Exception as e: print(f"无法发送 pickwinner 公告 {message_id}: {e}")
-    participant_count_display = len(specified_winners)
-    try:
-        updated_embed = update_embed_ended(original_embed, winner_mentions, prize, participant_count_display)
-        updated_embed.title = "👑 **抽奖已结束 (手动指定)** 👑"
-        await message.edit(embed=updated_embed, view=None)
-    except Exception as e: print(f"无法编辑 pickwinner 消息 {message_id}: {e}")
-    await delete_giveaway_data(message_id); print(f"已手动结束并从 Redis 移除抽奖 {message_id} (pickwinner)。")
+    announced = False
+    # 与到期结算使用同一租约；进行中的抽奖还需占用公告标记，与到期结算重叠时只有一方会公告并归档。
+    # 已结束的抽奖 (Redis 中无数据) 不检查公告标记，管理员仍可覆盖其获奖者
+    async with giveaway_end_lease(message_id, interaction.guild.id, target_channel.id, require_active=giveaway_data is not None) as acquired:
+        if acquired and (announced := giveaway_data is None or await claim_giveaway_announcement(message_id)):
+            try: await enqueue_announcement(target_channel, result_message)
+            except Exception as e: log.warning(f"无法发送 pickwinner 公告 {message_id}: {e}")
+            participant_count_display = len(specified_winners)
+            try:
+                updated_embed = update_embed_ended(original_embed, winner_mentions, prize, participant_count_display)
+                updated_embed.title = "👑 **抽奖已结束 (手动指定)** 👑"
+                await enqueue_embed_edit(target_channel, message_id, updated_embed, clear_view=True)
+            except Exception as e: log.warning(f"无法编辑 pickwinner 消息 {message_id}: {e}")
+            if giveaway_data:
+                eligible_ids = filter_eligible_participant_ids(interaction.guild, await load_giveaway_participant_ids(message_id), giveaway_data)
+                await archive_giveaway_result(message_id, giveaway_data, eligible_ids, [w.id for w in specified_winners], original_embed.footer.icon_url if original_embed.footer else None)
+            await delete_giveaway_data(message_id); log.info(f"已手动结束并从 Redis 移除抽奖 {message_id} (pickwinner)。")
+    if not announced: await interaction.followup.send("该抽奖正在结算中，未做更改。", ephemeral=True); return
     await interaction.followup.send(f"✅ 已成功指定 `{prize}` 中奖者为 {winner_mentions} 并结束。", ephemeral=True)
 
 @giveaway_pickwinner.error
 async def pickwinner_error(interaction: nextcord.Interaction, error):
     if isinstance(error, commands.MissingPermissions): await interaction.response.send_message("抱歉，你没有权限执行此命令。", ephemeral=True)
-    else: await interaction.response.send_message(f"执行 pickwinner 命令出错: {error}", ephemeral=True); print(f"Error in pickwinner cmd: {error}")
+    else: await interaction.response.send_message(f"执行 pickwinner 命令出错: {error}", ephemeral=True); log.error(f"Error in pickwinner cmd: {error}")
 
 
 @giveaway.subcommand(name="end", description="⏱️ [管理员] 立即结束抽奖并随机抽取获胜者。")
 @commands.has_permissions(manage_guild=True)
+@instrumented_command("end")
 async def giveaway_end(interaction: nextcord.Interaction, message_link_or_id: str = ...):
     await interaction.response.defer(ephemeral=True)
     channel_id, message_id = await parse_message_link(interaction, message_link_or_id)
@@ -271,63 +1215,249 @@ async def giveaway_end(interaction: nextcord.Interaction, message_link_or_id: st
     try: message = await target_channel.fetch_message(message_id)
     except nextcord.NotFound: await interaction.followup.send("无法找到原始抽奖消息。", ephemeral=True); return
     except nextcord.Forbidden: await interaction.followup.send(f"无权限在 {target_channel.mention} 读取历史记录。", ephemeral=True); return
-    except Exception as e: await interaction.followup.send(f"获取消息时出错: {e}", ephemeral=True); print(f"Error fetch msg giveaway_end {message_id}: {e}"); return
+    except Exception as e: await interaction.followup.send(f"获取消息时出错: {e}", ephemeral=True); log.error(f"Error fetch msg giveaway_end {message_id}: {e}"); return
     giveaway_data = await load_giveaway_data(message_id)
     if not giveaway_data:
         if message.embeds and ("结束" in message.embeds[0].title or (message.embeds[0].footer and "已结束" in message.embeds[0].footer.text)):
              await interaction.followup.send("该抽奖似乎已经结束了。", ephemeral=True)
         else: await interaction.followup.send("错误：无法从 Redis 加载此抽奖数据。", ephemeral=True)
         return
-    print(f"用户 {interaction.user} 手动结束抽奖 {message_id}...")
-    await process_giveaway_end(message, giveaway_data)
-    await delete_giveaway_data(message_id); print(f"已手动结束并从 Redis 移除抽奖 {message_id} (end command)。")
+    log.info(f"用户 {interaction.user} 手动结束抽奖 {message_id}...")
+    async with giveaway_end_lease(message_id, interaction.guild.id, target_channel.id) as acquired:
+        if acquired: await process_giveaway_end(message, giveaway_data); await delete_giveaway_data(message_id); log.info(f"已手动结束并从 Redis 移除抽奖 {message_id} (end command)。")
+    if not acquired: await interaction.followup.send("该抽奖正在结算中或已经结束。", ephemeral=True); return
     await interaction.followup.send(f"✅ 已手动结束 `{giveaway_data.get('prize', '未知奖品')}` 的抽奖。", ephemeral=True)
 
 @giveaway_end.error
 async def end_error(interaction: nextcord.Interaction, error):
     if isinstance(error, commands.MissingPermissions): await interaction.response.send_message("抱歉，你没有权限执行此命令。", ephemeral=True)
-    else: await interaction.response.send_message(f"执行 end 命令出错: {error}", ephemeral=True); print(f"Error in end cmd: {error}")
+    else: await interaction.response.send_message(f"执行 end 命令出错: {error}", ephemeral=True); log.error(f"Error in end cmd: {error}")
+
+
+@giveaway.subcommand(name="list", description="📋 [管理员] 分页查看本服务器进行中或最近结束的抽奖。")
+@commands.has_permissions(manage_guild=True)
+@instrumented_command("list")
+async def giveaway_list(interaction: nextcord.Interaction, status: str = nextcord.SlashOption(description="进行中 / 最近结束", choices={"进行中": "active", "最近结束": "ended"}, required=False, default="active"), page: int = 1):
+    await interaction.response.defer(ephemeral=True)
+    page = max(page, 1); entries, total = await get_guild_giveaway_page(interaction.guild.id, status, page)
+    total_pages = max((total + LIST_PAGE_SIZE - 1) // LIST_PAGE_SIZE, 1)
+    if not entries: await interaction.followup.send("没有找到抽奖。" if total == 0 else f"页码超出范围 (共 {total_pages} 页)。", ephemeral=True); return
+    message_ids = [message_id for message_id, _ in entries]
+    details = await load_many(message_ids) if status == 'active' else await load_archive_summaries(message_ids)
+    lines = []; stale_ids = [message_id for message_id, _ in entries if message_id not in details]
+    if status == 'active' and stale_ids and redis_pool: await redis_pool.zrem(f"{GUILD_ACTIVE_PREFIX}{interaction.guild.id}", *[str(message_id) for message_id in stale_ids]) # 记录已不存在的索引项
+    for message_id, timestamp in entries:
+        info = details.get(message_id)
+        if not info: lines.append(f"`{message_id}` · (记录已过期) · <t:{int(timestamp)}:R>"); continue
+        link = f"https://discord.com/channels/{interaction.guild.id}/{info['channel_id']}/{message_id}"
+        lines.append(f"[`{info.get('prize', '未知奖品')}`]({link}) · {info.get('winners', 1)} 位获奖者 · {'结束于' if status == 'active' else '已于'} <t:{int(timestamp)}:R>{'' if status == 'active' else ' 结束'}")
+    embed = nextcord.Embed(title=f"📋 {'进行中' if status == 'active' else '最近结束'}的抽奖 ({total})", description="\n".join(lines), color=0x00FFFF)
+    embed.set_footer(text=f"第 {page}/{total_pages} 页")
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@giveaway_list.error
+async def list_error(interaction: nextcord.Interaction, error):
+    if isinstance(error, commands.MissingPermissions): await interaction.response.send_message("抱歉，你没有权限执行此命令。", ephemeral=True)
+    else: await interaction.response.send_message(f"执行 list 命令出错: {error}", ephemeral=True); log.error(f"Error in list cmd: {error}")
+
+async def resolve_bulk_targets(interaction: nextcord.Interaction, targets: str) -> list[int] | None:
+    if targets.strip().lower() == 'all': active_ids = await get_guild_active_giveaway_ids(interaction.guild.id)
+    else:
+        message_ids, invalid = parse_giveaway_targets(targets)
+        if invalid: await interaction.followup.send(f"无法解析: `{' '.join(invalid)}`", ephemeral=True); return None
+        active_ids = await get_guild_active_giveaway_ids(interaction.guild.id, message_ids) # 只接受本服务器仍在进行的抽奖
+    return [message_id for message_id in active_ids if message_id not in _giveaways_in_progress]
+
+@giveaway.subcommand(name="bulkend", description="⏱️ [管理员] 立即结束多个抽奖 (消息 ID/链接，空格分隔，或 all)。")
+@commands.has_permissions(manage_guild=True)
+@instrumented_command("bulkend")
+async def giveaway_bulkend(interaction: nextcord.Interaction, targets: str = ...):
+    await interaction.response.defer(ephemeral=True)
+    message_ids = await resolve_bulk_targets(interaction, targets)
+    if message_ids is None: return
+    if not message_ids: await interaction.followup.send("没有找到可结束的进行中抽奖。", ephemeral=True); return
+    ended_ids = await end_many_now(message_ids); log.info(f"用户 {interaction.user} 批量结束抽奖 {ended_ids}")
+    await interaction.followup.send(f"✅ 已提交 {len(ended_ids)} 个抽奖立即结束，获奖公告将陆续发出。", ephemeral=True)
+
+@giveaway_bulkend.error
+async def bulkend_error(interaction: nextcord.Interaction, error):
+    if isinstance(error, commands.MissingPermissions): await interaction.response.send_message("抱歉，你没有权限执行此命令。", ephemeral=True)
+    else: await interaction.response.send_message(f"执行 bulkend 命令出错: {error}", ephemeral=True); log.error(f"Error in bulkend cmd: {error}")
+
+@giveaway.subcommand(name="bulkcancel", description="🗑️ [管理员] 取消多个抽奖且不抽奖 (消息 ID/链接，空格分隔，或 all)。")
+@commands.has_permissions(manage_guild=True)
+@instrumented_command("bulkcancel")
+async def giveaway_bulkcancel(interaction: nextcord.Interaction, targets: str = ...):
+    await interaction.response.defer(ephemeral=True)
+    message_ids = await resolve_bulk_targets(interaction, targets)
+    if message_ids is None: return
+    if not message_ids: await interaction.followup.send("没有找到可取消的进行中抽奖。", ephemeral=True); return
+    # 一次批量完成: 流水线获取全部租约 (与结算使用同一租约，正在结算的抽奖不会被取消，取消后也不会再被结算)，
+    # 读取记录，删除仍存在的记录，流水线写入取消后的 Embed，最后一起释放租约
+    pending_ids = [message_id for message_id in message_ids if message_id not in _giveaways_in_progress]; _giveaways_in_progress.update(pending_ids)
+    leased_ids = []; cancelled_ids = []; failed = 0
+    try:
+        leased_ids = await acquire_giveaway_leases(pending_ids); giveaways = await load_many(leased_ids)
+        cancelled_ids = await delete_many(list(giveaways), {message_id: giveaway_data['guild_id'] for message_id, giveaway_data in giveaways.items()})
+        edits = []
+        for message_id in cancelled_ids:
+            channel = interaction.guild.get_channel(giveaways[message_id]['channel_id'])
+            if isinstance(channel, nextcord.TextChannel): edits.append((channel, message_id, create_cancelled_embed(giveaways[message_id]), True))
+            else: failed += 1
+        try: await enqueue_embed_edits(edits)
+        except Exception as e: failed += len(edits); log.error(f"编辑已取消抽奖消息出错: {e}")
+    finally: await release_giveaway_leases(leased_ids); _giveaways_in_progress.difference_update(pending_ids)
+    log.info(f"用户 {interaction.user} 批量取消抽奖 {cancelled_ids}"); skipped = len(message_ids) - len(cancelled_ids)
+    await interaction.followup.send(f"✅ 已取消 {len(cancelled_ids)} 个抽奖。" + (f" ({skipped} 个正在结算或已结束，已跳过)" if skipped else "") + (f" ({failed} 条消息未能更新)" if failed else ""), ephemeral=True)
+
+@giveaway_bulkcancel.error
+async def bulkcancel_error(interaction: nextcord.Interaction, error):
+    if isinstance(error, commands.MissingPermissions): await interaction.response.send_message("抱歉，你没有权限执行此命令。", ephemeral=True)
+    else: await interaction.response.send_message(f"执行 bulkcancel 命令出错: {error}", ephemeral=True); log.error(f"Error in bulkcancel cmd: {error}")
 
 
 # --- 后台任务 ---
-@tasks.loop(seconds=15)
+# 结算并发控制: 全局上限 + 每服务器上限 + 每频道串行 (同一频道的 send/edit 共享 Discord 路由限速桶)。
+# 获取顺序固定为 频道 -> 服务器 -> 全局，等待频道锁时不会占用全局名额。
+_end_semaphore = asyncio.Semaphore(GIVEAWAY_END_CONCURRENCY)
+# 每服务器信号量/每频道锁按需创建，[原语, 持有及等待者数] 归零时删除，不会为历史上所有频道常驻
+_guild_end_semaphores: dict[int, list] = {}
+_channel_end_locks: dict[int, list] = {}
+_giveaways_in_progress: set[int] = set() # 正在结算的抽奖，防止调度周期重叠或手动结束时重复处理
+_background_tasks: set[asyncio.Task] = set()
+
+@contextlib.asynccontextmanager
+async def _keyed_slot(registry: dict[int, list], key: int, factory):
+    entry = registry.get(key)
+    if entry is None: entry = registry[key] = [factory(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]: yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0 and registry.get(key) is entry: del registry[key]
+
+@contextlib.asynccontextmanager
+async def giveaway_end_slot(guild_id: int, channel_id: int):
+    async with _keyed_slot(_channel_end_locks, channel_id, asyncio.Lock), _keyed_slot(_guild_end_semaphores, guild_id, lambda: asyncio.Semaphore(GUILD_END_CONCURRENCY)), _end_semaphore: yield
+
+async def remove_stale_index_entry(message_id: int):
+    # 清理失效的索引项: 记录已不存在，服务器 ID 从开奖归档中找回 (如有) 以便一并移出服务器索引
+    try:
+        guild_id = await redis_pool.hget(f"{ARCHIVE_PREFIX}{message_id}", 'guild_id')
+        async with redis_pool.pipeline(transaction=True) as pipe:
+            for index_key in owned_giveaway_index_keys(): pipe.zrem(index_key, str(message_id)) # 该项来自本进程的某个分片索引
+            if guild_id: pipe.zrem(f"{GUILD_ACTIVE_PREFIX}{guild_id}", str(message_id))
+            await pipe.execute()
+    except Exception as e: log.error(f"清理抽奖 {message_id} 失效索引时出错: {e}")
+
+@contextlib.asynccontextmanager
+async def giveaway_end_lease(message_id: int, guild_id: int, channel_id: int, require_active: bool = True):
+    # 先进入结算槽位再获取租约，排队等待期间不消耗租约时长。yield 是否可以结算:
+    # 本进程未在处理、获得租约、且 (require_active 时) 抽奖记录仍存在 (未被其他进程结束)
+    if message_id in _giveaways_in_progress: yield False; return
+    _giveaways_in_progress.add(message_id); has_lease = False
+    try:
+        async with giveaway_end_slot(guild_id, channel_id):
+            has_lease = await acquire_giveaway_lease(message_id)
+            yield has_lease and (not require_active or bool(await redis_pool.exists(f"{GIVEAWAY_PREFIX}{message_id}")))
+    finally:
+        if has_lease: await release_giveaway_lease(message_id)
+        _giveaways_in_progress.discard(message_id)
+
+async def end_due_giveaway(message_id: int, giveaway_data: dict | None):
+    if message_id in _giveaways_in_progress: return
+    if not giveaway_data:
+        if not await redis_pool.exists(f"{GIVEAWAY_PREFIX}{message_id}"): await remove_stale_index_entry(message_id)
+        return
+    if not giveaway_data.get('guild_id') or not giveaway_data.get('channel_id'): log.warning(f"警告: 抽奖 {message_id} 记录缺少服务器/频道，删除。"); await delete_giveaway_data(message_id); return
+    if giveaway_data.get('guild_id') and not owns_guild(giveaway_data['guild_id']): return # 由负责该分片的进程处理
+    if not isinstance(giveaway_data.get('end_time'), datetime.datetime): log.warning(f"警告: 抽奖 {message_id} end_time 格式无效。"); await delete_giveaway_data(message_id); return
+    guild = bot.get_guild(giveaway_data['guild_id']); channel = guild.get_channel(giveaway_data['channel_id']) if guild else None
+    if not guild or not channel or not isinstance(channel, nextcord.TextChannel): log.warning(f"无法获取服务器/频道 {giveaway_data['guild_id']}/{giveaway_data['channel_id']}。"); return
+    async with giveaway_end_lease(message_id, guild.id, channel.id) as acquired:
+        if not acquired: return
+        log.info(f"抽奖 {message_id} 到期，处理...")
+        ended = False; outcome = 'ended'
+        try: message = await channel.fetch_message(message_id); await process_giveaway_end(message, giveaway_data); ended = True
+        except nextcord.NotFound: log.warning(f"消息 {message_id} 未找到。"); ended = True; outcome = 'message_not_found'
+        except nextcord.Forbidden: log.warning(f"无法获取消息 {message_id} (权限不足?)。"); outcome = 'forbidden'
+        except Exception as e: log.exception(f"处理到期抽奖 {message_id} 出错: {e}"); outcome = 'error'
+        inc_counter('giveaway_ended_total', outcome=outcome)
+        if ended:
+            await delete_giveaway_data(message_id); lateness = time.time() - giveaway_data['end_time'].timestamp(); observe('giveaway_end_lateness_seconds', lateness)
+            log.info(f"抽奖 {message_id} 已结算，延迟 {lateness:.2f} 秒。", extra={'fields': {'message_id': message_id, 'guild_id': guild.id, 'lateness_seconds': round(lateness, 3), 'outcome': outcome}})
+
 async def check_giveaways():
     if not redis_pool: return
-    current_time = datetime.datetime.now(datetime.timezone.utc); ended_giveaway_ids = []; giveaway_ids = await get_all_giveaway_ids()
+    inc_counter('giveaway_ticks_total')
+    with timed('giveaway_tick_seconds'): await _check_giveaways()
+
+async def _check_giveaways():
+    current_time = datetime.datetime.now(datetime.timezone.utc); giveaway_ids = await get_due_giveaway_ids(current_time)
+    giveaway_ids = [message_id for message_id in giveaway_ids if message_id not in _giveaways_in_progress]
     if not giveaway_ids: return
-    for message_id in giveaway_ids:
-        giveaway_data = await load_giveaway_data(message_id)
-        if not giveaway_data: continue
-        if not isinstance(giveaway_data.get('end_time'), datetime.datetime): print(f"警告: 抽奖 {message_id} end_time 格式无效。"); await delete_giveaway_data(message_id); continue
-        if giveaway_data['end_time'] <= current_time:
-            print(f"抽奖 {message_id} 到期，处理...")
-            guild = bot.get_guild(giveaway_data['guild_id']); channel = guild.get_channel(giveaway_data['channel_id']) if guild else None
-            if not guild or not channel or not isinstance(channel, nextcord.TextChannel): print(f"无法获取服务器/频道 {giveaway_data['guild_id']}/{giveaway_data['channel_id']}。"); continue
-            try: message = await channel.fetch_message(message_id); await process_giveaway_end(message, giveaway_data); ended_giveaway_ids.append(message_id)
-            except nextcord.NotFound: print(f"消息 {message_id} 未找到。"); ended_giveaway_ids.append(message_id)
-            except nextcord.Forbidden: print(f"无法获取消息 {message_id} (权限不足?)。")
-            except Exception as e: print(f"处理到期抽奖 {message_id} 出错: {e}")
-    if ended_giveaway_ids: print(f"清理 Redis: {ended_giveaway_ids}"); [await delete_giveaway_data(msg_id) for msg_id in ended_giveaway_ids]
-
-@check_giveaways.before_loop
-async def before_check_giveaways():
-    await bot.wait_until_ready(); print("检查抽奖任务已准备就绪。")
+    log.info(f"本轮到期抽奖: {len(giveaway_ids)} 个。", extra={'fields': {'due': len(giveaway_ids)}}); inc_counter('giveaway_due_total', len(giveaway_ids))
+    giveaways = await load_many(giveaway_ids) # 整批到期抽奖只需一次往返
+    await asyncio.gather(*(end_due_giveaway(message_id, giveaways.get(message_id)) for message_id in giveaway_ids))
 
 # --- 机器人事件 ---
+@bot.event
+async def on_member_update(before: nextcord.Member, after: nextcord.Member):
+    before_ids = {r.id for r in before.roles}; after_ids = {r.id for r in after.roles}
+    if before_ids != after_ids: index_member_roles(after, after_ids - before_ids, add=True); index_member_roles(after, before_ids - after_ids, add=False)
+
+@bot.event
+async def on_member_join(member: nextcord.Member):
+    index_member_roles(member, {r.id for r in member.roles}, add=True)
+
+@bot.event
+async def on_member_remove(member: nextcord.Member):
+    index_member_roles(member, {r.id for r in member.roles}, add=False)
+
+@bot.event
+async def on_guild_role_delete(role: nextcord.Role):
+    index = _role_member_index.get(role.guild.id)
+    if index is not None: index.pop(role.id, None)
+
+@bot.event
+async def on_guild_remove(guild: nextcord.Guild):
+    _role_member_index.pop(guild.id, None)
+
+@bot.event
+async def on_guild_available(guild: nextcord.Guild):
+    # 重新 IDENTIFY (非 RESUME) 时断线期间的身份组变更不会触发 on_member_update，丢弃旧索引按需重建
+    _role_member_index.pop(guild.id, None)
+
+@bot.event
+async def on_raw_reaction_add(payload: nextcord.RawReactionActionEvent):
+    if not payload.guild_id or str(payload.emoji) != GIVEAWAY_EMOJI or payload.user_id == bot.user.id: return
+    await update_giveaway_participant(payload.message_id, payload.user_id, 'add')
+
+@bot.event
+async def on_raw_reaction_remove(payload: nextcord.RawReactionActionEvent):
+    if not payload.guild_id or str(payload.emoji) != GIVEAWAY_EMOJI or payload.user_id == bot.user.id: return
+    await update_giveaway_participant(payload.message_id, payload.user_id, 'remove')
+
 @bot.event
 async def on_ready():
-    print("-" * 30); print(f'已登录为: {bot.user.name} ({bot.user.id})'); print(f'Nextcord 版本: {nextcord.__version__}'); print(f'运行于: {len(bot.guilds)} 个服务器')
+    global giveaway_scheduler_task, reconcile_task
+    log.info(f'已登录为: {bot.user.name} ({bot.user.id})', extra={'fields': {'nextcord_version': nextcord.__version__, 'guilds': len(bot.guilds), 'shard_ids': bot.shard_ids, 'shard_count': bot.shard_count, 'worker': f"{WORKER_INDEX + 1}/{WORKER_COUNT}"}})
+    await start_metrics_server()
     if not redis_pool: await setup_redis()
     redis_status = "未知"
     if redis_pool:
         try: await redis_pool.ping(); redis_status = "已连接"
         except Exception as e: redis_status = f"连接失败 ({e})"
-    print(f'Redis 连接池状态: {redis_status}'); print("-" * 30)
+    log.info(f'Redis 连接池状态: {redis_status}')
     if redis_status == "已连接":
-        if not check_giveaways.is_running(): check_giveaways.start(); print("已启动后台检查抽奖任务。")
-    else: print("警告: Redis 连接失败，后台任务未启动。")
+        await migrate_giveaway_index()
+        if giveaway_scheduler_task is None or giveaway_scheduler_task.done(): await resync_schedule(time.time()); giveaway_scheduler_task = asyncio.create_task(giveaway_scheduler()); log.info("已启动后台抽奖调度器。")
+        if reconcile_task is None or reconcile_task.done(): reconcile_task = asyncio.create_task(reconcile_active_giveaways())
+        await recover_outbox()
+    else: log.warning("警告: Redis 连接失败，后台任务未启动。")
 
 # --- 运行机器人 ---
 if __name__ == "__main__":
-    print("正在启动机器人...")
+    log.info("正在启动机器人...")
     bot.run(BOT_TOKEN)
\ No newline at end of file